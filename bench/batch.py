@@ -0,0 +1,55 @@
+"""Manager throughput, one event per queue get against batch draining
+
+Queues a burst of message events for a channel and times how long the
+manager takes to route them to a bridge that does nothing with them.
+
+Usage: python -m bench.batch [--events N] [--batch-size N ...]
+"""
+
+import argparse
+from time import perf_counter
+
+from yetibridge import BridgeManager
+from yetibridge.bridge import BaseBridge
+from yetibridge.event import Event, Target
+
+
+class NullBridge(BaseBridge):
+    def ev_message(self, event, content, segments=None):
+        pass
+
+def run(events, batch_size):
+    manager = BridgeManager({}, batch_size=batch_size)
+    bridge = NullBridge({})
+    manager.attach('null', bridge)
+    bridge.join_channel('channel')
+    while not manager.events.empty():
+        manager.once()
+
+    channel_id = bridge.get_channel_by_name('channel').id
+    for i in range(events):
+        manager.events.put(Event(bridge, channel_id, 'message', 'text',
+                                 segments=()))
+
+    start = perf_counter()
+    while not manager.events.empty():
+        if batch_size == 1:
+            manager.once()
+        else:
+            manager.once_batch()
+    return perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, nargs='+',
+                        default=[1, 16, 512])
+    args = parser.parse_args()
+
+    for batch_size in args.batch_size:
+        elapsed = run(args.events, batch_size)
+        print("batch_size {:>5}: {:8.0f} events/s"
+              "".format(batch_size, args.events / elapsed))
+
+if __name__ == '__main__':
+    main()
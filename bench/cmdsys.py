@@ -0,0 +1,48 @@
+"""Splitting a long command line into words
+
+Builds a command line of plain, escaped and quoted words and times how
+long cmdsys.split takes to tokenize it, next to the original three pass
+tokenizer kept in the tests.
+
+Usage: python -m bench.cmdsys [--size CHARS] [--rounds N]
+"""
+
+import argparse
+import random
+from time import perf_counter
+
+from yetibridge.cmdsys import split
+from tests.test_cmdsys import reference_split
+
+
+WORDS = ['word', 'two\\ words', '"quoted text"', '"with \\"quotes\\""',
+         'back\\\\slash', '\tindented', 'x']
+
+
+def run(func, string, rounds):
+    start = perf_counter()
+    for i in range(rounds):
+        func(string)
+    return (perf_counter() - start) / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=19000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    words = []
+    length = 0
+    while length < args.size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    string = ' '.join(words)
+
+    new = run(split, string, args.rounds)
+    old = run(reference_split, string, args.rounds)
+    print("{} chars: {:8.2f} ms, reference {:8.2f} ms"
+          "".format(len(string), new * 1000, old * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Memory and construction cost of Event objects
+
+Holds a million message events at once and reports the memory they
+retain and how long they took to create, for the slotted Event and for
+the plain __dict__ layout it replaced.
+
+Usage: python -m bench.events [--events N]
+"""
+
+import argparse
+import gc
+import tracemalloc
+from time import perf_counter
+
+from yetibridge.event import Event, Name
+
+
+class DictEvent:
+    # The Event layout before it was slotted, for comparison
+    def __init__(self, source, target, name, *args, **kwargs):
+        self.target_id = target if type(target) is int else id(target)
+        self.source_id = source if type(source) is int else id(source)
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+def measure(cls, events):
+    # Names built at runtime, as when decoded from the wire, are only
+    # shared between events if they are interned.
+    name = ''.join(Name.message)
+    gc.collect()
+    start = perf_counter()
+    held = [cls(1, 2, name, 'text') for i in range(events)]
+    elapsed = perf_counter() - start
+    del held
+
+    gc.collect()
+    tracemalloc.start()
+    held = [cls(1, 2, name, 'text') for i in range(events)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return size, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--events', type=int, default=1000000)
+    args = parser.parse_args()
+
+    per_million = 1000000 / args.events
+    for cls in (DictEvent, Event):
+        size, elapsed = measure(cls, args.events)
+        print("{:>9}: {:6.1f} MB and {:5.2f} s per million events"
+              "".format(cls.__name__, size * per_million / 2**20,
+                        elapsed * per_million))
+
+if __name__ == '__main__':
+    main()
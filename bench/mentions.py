@@ -0,0 +1,82 @@
+"""Resolving @mentions in IRC messages against thousands of nicks
+
+Times finding the longest known nick at the start of each @word in a
+message, with the NickTrie the IRC bridge uses and with the probing of
+every prefix of the word, longest first, that it replaced.
+
+Usage: python -m bench.mentions [--nicks N ...] [--words N] [--length N]
+"""
+
+import argparse
+import random
+import string
+from time import perf_counter
+
+from irc.dict import IRCDict
+
+from yetibridge.bridge.irc import NickTrie, _mention
+
+
+def probe(user_map, nick):
+    for i in range(len(nick), 0, -1):
+        if nick[:i] in user_map:
+            return i
+    return 0
+
+def walk(trie, user_map, nick):
+    length = trie.longest_prefix(nick)
+    if length and nick[:length] in user_map:
+        return length
+    return 0
+
+def run(func, message, rounds):
+    start = perf_counter()
+    for i in range(rounds):
+        for match in _mention.finditer(message):
+            func(match.group(1))
+    return (perf_counter() - start) / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nicks', type=int, nargs='+',
+                        default=[100, 2000, 10000])
+    parser.add_argument('--words', type=int, default=200)
+    parser.add_argument('--length', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    letters = string.ascii_letters + string.digits + '[]\\^_`{|}'
+    for count in args.nicks:
+        user_map = IRCDict()
+        trie = NickTrie()
+        nicks = set()
+        while len(nicks) < count:
+            nicks.add(''.join(rng.choice(letters)
+                              for i in range(rng.randint(3, 16))))
+        for nick in nicks:
+            user_map[nick] = id(nick)
+            trie.add(nick)
+
+        # Half the words mention a known nick followed by trailing text,
+        # the rest only share its first few characters.
+        nicks = sorted(nicks)
+        words = []
+        for i in range(args.words):
+            nick = rng.choice(nicks)
+            if i % 2:
+                nick = nick[:2]
+            tail = ''.join(rng.choice(letters)
+                           for i in range(args.length - len(nick)))
+            words.append('@' + nick + tail)
+        message = ' '.join(words)
+
+        walked = run(lambda nick: walk(trie, user_map, nick),
+                     message, args.rounds)
+        probed = run(lambda nick: probe(user_map, nick),
+                     message, args.rounds)
+        print("{:>6} nicks: trie {:7.2f} ms, probing {:7.2f} ms"
+              "".format(count, walked * 1000, probed * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Idle CPU and wakeup latency of the IRC bot connections
+
+Connects many bots to idle sockets from socketpair and measures the CPU
+the polling loop uses over a few seconds, then how long a line sent to
+one of the bots takes to be handled.  The SharedReactor used by the IRC
+bridge is compared with the previous loop, which waited 200 ms on the
+bridge bot's reactor and then polled each user bot's own reactor.  The
+previous loop uses select() and is skipped when the sockets do not fit
+in its descriptor limit.
+
+Usage: python -m bench.reactor [--bots N ...] [--seconds S]
+"""
+
+import argparse
+import resource
+import socket
+import threading
+from time import perf_counter, process_time
+
+from irc.client import Reactor
+
+from yetibridge.bridge.irc import BotReactor, SharedReactor
+
+
+# select() refuses descriptors from this number on
+FD_SETSIZE = 1024
+
+
+class IdleConnection:
+    # Stands in for a ServerConnection, noting when data arrives
+    def __init__(self, sock):
+        self.socket = sock
+        self.received = None
+
+    def process_data(self):
+        if self.socket.recv(4096):
+            self.received = perf_counter()
+
+def connect(count, make_reactor):
+    reactors = []
+    peers = []
+    for i in range(count):
+        sock, peer = socket.socketpair()
+        sock.setblocking(False)
+        reactor = make_reactor(sock)
+        reactor.connections.append(IdleConnection(sock))
+        reactors.append(reactor)
+        peers.append(peer)
+    return reactors, peers
+
+def shared_layout(count):
+    shared = SharedReactor()
+
+    def make_reactor(sock):
+        reactor = BotReactor(shared)
+        shared.register(sock, reactor)
+        return reactor
+
+    reactors, peers = connect(count, make_reactor)
+    return reactors, peers, lambda: shared.process_once(0.2)
+
+def polled_layout(count):
+    reactors, peers = connect(count, lambda sock: Reactor())
+
+    def poll():
+        reactors[0].process_once(0.2)
+        for reactor in reactors[1:]:
+            reactor.process_once(0)
+
+    return reactors, peers, poll
+
+def measure(layout, count, seconds):
+    reactors, peers, poll = layout(count)
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            poll()
+
+    thread = threading.Thread(target=loop)
+    start = process_time()
+    thread.start()
+    stop.wait(seconds)
+    idle = process_time() - start
+
+    connection = reactors[-1].connections[0]
+    sent = perf_counter()
+    peers[-1].send(b'PING :bench\r\n')
+    while connection.received is None:
+        stop.wait(0.0001)
+    latency = connection.received - sent
+
+    stop.set()
+    thread.join()
+    for reactor, peer in zip(reactors, peers):
+        reactor.connections[0].socket.close()
+        peer.close()
+
+    return idle, latency
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bots', type=int, nargs='+', default=[400, 1000])
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    needed = 2 * max(args.bots) + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+    for count in args.bots:
+        layouts = [('shared', shared_layout)]
+        if 2 * count + 16 < FD_SETSIZE:
+            layouts.append(('polled', polled_layout))
+
+        for name, layout in layouts:
+            idle, latency = measure(layout, count, args.seconds)
+            print("{:>5} bots, {}: {:6.0f} ms CPU idle over {} s, line "
+                  "handled after {:.1f} ms".format(count, name, idle * 1000,
+                                                   args.seconds,
+                                                   latency * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Wrapping a long paste, as relayed from Discord to IRC
+
+Builds a paste of mixed ASCII and multi-byte text and times how long
+Utf8Wrapper takes to cut it into IRC sized lines, next to the original
+list based wrapper kept in the tests.
+
+Usage: python -m bench.utf8wrap [--size BYTES] [--width N ...] [--rounds N]
+"""
+
+import argparse
+import random
+from time import perf_counter
+
+from yetibridge.utf8wrap import Utf8Wrapper
+from tests.test_utf8wrap import ReferenceWrapper, random_text
+
+
+def run(wrapper, text, rounds):
+    start = perf_counter()
+    for i in range(rounds):
+        wrapper.wrap(text)
+    return (perf_counter() - start) / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=57000)
+    parser.add_argument('--width', type=int, nargs='+', default=[100, 400])
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    text = random_text(random.Random(0), args.size).encode('UTF-8')
+    text = text[:args.size].decode('UTF-8', 'ignore')
+
+    for width in args.width:
+        new = run(Utf8Wrapper(width=width), text, args.rounds)
+        old = run(ReferenceWrapper(width=width), text, args.rounds)
+        print("width {:>4}: {:8.2f} ms, reference {:8.2f} ms"
+              "".format(width, new * 1000, old * 1000))
+
+if __name__ == '__main__':
+    main()
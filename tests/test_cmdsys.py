@@ -0,0 +1,132 @@
+"""Command parsing and running
+
+split is checked against the original three pass tokenizer.
+"""
+
+import random
+
+import pytest
+
+from yetibridge.cmdsys import command, commands, run_command, split
+
+
+class _Literal:
+    def __init__(self, characters):
+        self.characters = ''
+        for char in characters:
+            if isinstance(char, _Literal):
+                self.characters += char.characters
+            else:
+                self.characters += char
+
+def reference_split(string):
+    """split as it was before it was driven by a regex"""
+
+    # Turn into a list of characters
+    array = list(map(str, string))
+
+    # Turn escaped characters into character literals
+    escaped = []
+    while array:
+        item = array.pop(0)
+        if item == '\\' and array:
+            escaped.append(_Literal(array.pop(0)))
+        else:
+            escaped.append(item)
+
+    # Turn quoted string into word literals.
+    quoted = []
+    while escaped:
+        item = escaped.pop(0)
+        if item == '"':
+            word = []
+            while escaped:
+                item = escaped.pop(0)
+                if item =='"':
+                    quoted.append(_Literal(word))
+                    break
+                else:
+                    word.append(item)
+            else:
+                raise ValueError("unmatched quote")
+        else:
+            quoted.append(item)
+
+    # Join adjacent sequences of literals and characters not
+    # separated by blanks.
+    split = []
+    word = []
+    while quoted:
+        item = quoted.pop(0)
+        if item != " " and item != "\t":
+            word.append(item)
+        elif word:
+            split.append(_Literal(word))
+            word.clear()
+    if word:
+        split.append(_Literal(word))
+
+    # Turn the sequence of literals into a list of strings
+    return list(map(lambda l: l.characters, split))
+
+
+ALPHABET = 'ab\\"\\" \t\n'
+
+
+def outcome(func, string):
+    try:
+        return func(string)
+    except ValueError as e:
+        return ValueError, str(e)
+
+
+def test_docstring_example():
+    string = r'Augment\ this  "string"_\"battle\" '
+    assert split(string) == ['Augment this', 'string_"battle"']
+
+
+@pytest.mark.parametrize('string', [
+    '', ' ', '\t', '\n', '\\', '\\\\', '\\ ', '"', '""', '"" ""', 'a""b',
+    '"\\"', '"\\""', '"a\\', 'a\\\n b', '"a\tb" c', ' a \t b\n',
+])
+def test_edge_cases(string):
+    assert outcome(split, string) == outcome(reference_split, string)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_strings(seed):
+    rng = random.Random(seed)
+    for i in range(500):
+        string = ''.join(rng.choice(ALPHABET)
+                         for j in range(rng.randint(0, 24)))
+        expected = outcome(reference_split, string)
+        assert outcome(split, string) == expected, string
+
+
+class Commands:
+    @command
+    def _echo(self, word, *rest):
+        return ' '.join((word,) + rest)
+
+    @command
+    def _quiet(self):
+        pass
+
+    @command
+    def _fail(self):
+        raise RuntimeError("failed")
+
+
+@pytest.mark.parametrize('words, replies', [
+    (['echo', 'a', 'b'], ['a b']),
+    (['quiet'], []),
+    ([], ['error: empty command']),
+    (['nope'], ["error: 'nope' unknown command"]),
+    (['echo'], ['error: usage: echo <word> [rest...]']),
+    (['quiet', 'x'], ['error: usage: quiet']),
+    (['fail'], ['error: failed']),
+])
+def test_run_command(words, replies):
+    replied = []
+    run_command(commands(Commands, '_'), Commands(), words, replied.append)
+    assert replied == replies
@@ -0,0 +1,38 @@
+"""Pacing and capping of the IRC bots' send queues"""
+
+from yetibridge.bridge.irc import SendQueue
+
+
+def test_targets_take_turns():
+    queue = SendQueue(burst=4, rate=1)
+    for i in range(3):
+        queue.put('#paste', 'paste {}'.format(i))
+    queue.put('#quiet', 'hello')
+
+    lines, delay = queue.take()
+    assert lines == ['paste 0', 'hello', 'paste 1', 'paste 2']
+    assert delay is None
+    assert queue.depth == 0
+
+
+def test_limit_drops_from_longest_queue():
+    queue = SendQueue(burst=0, rate=1, limit=3)
+    for i in range(5):
+        queue.put('#paste', 'paste {}'.format(i))
+    queue.put('#quiet', 'hello')
+
+    assert queue.depth == 3
+    assert queue.dropped == 3
+
+    queue.burst = queue._tokens = 3
+    lines, delay = queue.take()
+    assert lines == ['paste 0', 'hello', 'paste 1']
+
+
+def test_no_limit():
+    queue = SendQueue(burst=0, rate=1)
+    for i in range(1000):
+        queue.put('#paste', 'line')
+
+    assert queue.depth == 1000
+    assert queue.dropped == 0
@@ -0,0 +1,125 @@
+"""Utf8Wrapper checked against the original list based implementation"""
+
+import random
+
+import pytest
+
+from yetibridge.utf8wrap import Utf8Wrapper
+
+
+class ReferenceWrapper:
+    """The wrapper as it was before it worked on byte offsets"""
+
+    def __init__(self, **kwargs):
+        self.width = kwargs.get('width', 100)
+
+    def _split_words(self, text):
+        while text:
+            word = []
+            seen_non_space = False
+            for byte in text:
+                if byte != 0x20:
+                    seen_non_space = True
+                elif seen_non_space and byte == 0x20:
+                    break
+
+                word.append(byte)
+
+            if seen_non_space:
+                yield word
+            text[:len(word)] = []
+
+    def _split_chars(self, word):
+        while word:
+            chars = [word.pop(0)]
+            for char in word:
+                if 0x80 <= char < 0xC0:
+                    chars.append(char)
+                else:
+                    break
+
+            yield(chars)
+            word[:len(chars)-1] = []
+
+    def _lay_long_word(self, word):
+        chars = list(self._split_chars(word))
+        line = []
+        while chars:
+            char = chars.pop(0)
+            if len(char) < self.width - len(line):
+                line.extend(char)
+            else:
+                yield line
+                line = char
+
+        if line:
+            yield line
+
+    def _lay_lines(self, words):
+        line = []
+        while words:
+            word = words.pop(0)
+            if len(word) < self.width - len(line):
+                line.extend(word)
+            elif not line:
+                for line in self._lay_long_word(word):
+                    yield bytes(line).decode('UTF-8')
+                line = []
+            else:
+                yield bytes(line).decode('UTF-8')
+                line = word
+
+        if line:
+            yield bytes(line).decode('UTF-8')
+
+    def wrap(self, text):
+        text = text.encode('UTF-8')
+
+        text = list(text)
+        words = list(self._split_words(text))
+
+        return list(self._lay_lines(words))
+
+
+# One, two, three and four byte characters, a combining accent, and
+# plenty of spaces so both short and long words come up.
+ALPHABET = 'ab éø €日 \U0001f600́  '
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(ALPHABET) for i in range(length))
+
+
+@pytest.mark.parametrize('text', [
+    '', ' ', '   ', 'a', 'a b', ' a', 'a ', 'word  word',
+    'ééé', '\U0001f600\U0001f600', 'éé',
+])
+@pytest.mark.parametrize('width', range(1, 9))
+def test_edge_cases(text, width):
+    expected = ReferenceWrapper(width=width).wrap(text)
+    assert Utf8Wrapper(width=width).wrap(text) == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_text(seed):
+    rng = random.Random(seed)
+    for i in range(200):
+        width = rng.randint(1, 12)
+        text = random_text(rng, rng.randint(0, 60))
+        expected = ReferenceWrapper(width=width).wrap(text)
+        assert Utf8Wrapper(width=width).wrap(text) == expected, (width, text)
+
+
+def test_long_paste():
+    rng = random.Random(0)
+    text = random_text(rng, 5000)
+    for width in (50, 400):
+        expected = ReferenceWrapper(width=width).wrap(text)
+        assert Utf8Wrapper(width=width).wrap(text) == expected
+
+
+def test_lines_fit_width():
+    rng = random.Random(1)
+    text = random_text(rng, 2000)
+    for line in Utf8Wrapper(width=40).wrap(text):
+        assert len(line.encode('UTF-8')) < 40
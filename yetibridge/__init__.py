@@ -1,14 +1,64 @@
-import queue
 import collections
+import itertools
+import logging
+from functools import partial
+from time import monotonic
 
-from .cmdsys import command, is_command
-from .event import Event, Target
+from .cmdsys import command, commands, run_command
+from .dispatch import BridgeWorker, ChannelPartitions
+from .event import Event, EventQueue, Name, Target, handler_table
+from .registry import Registry
+from .segments import parse
 
 class BridgeChannel:
+    # Every membership change is logged under a new version, taken from
+    # a counter shared by all channels of the manager.  A version can
+    # then only be one of this channel's if it is not older than the
+    # channel itself, and a bridge rejoining with the version it last
+    # saw is sent the changes since instead of the whole roster.
+
     def __init__(self, manager):
         self._manager = manager
         self.bridges = set()
+        self.destinations = ()
         self.users = {}
+        self.version = self._base = next(manager._versions)
+        self._log = collections.deque()
+        self._log_size = manager.config.get('membership_log', 256)
+        self._snapshot = None
+
+    def _commit(self, changes):
+        self.version = next(self._manager._versions)
+        self._snapshot = None
+        for user_id, name in changes:
+            if len(self._log) == self._log_size:
+                self._base = self._log.popleft()[0]
+            self._log.append((self.version, user_id, name))
+
+    def snapshot(self):
+        """Return the users as a tuple of (user_id, name) pairs"""
+        if self._snapshot is None:
+            self._snapshot = tuple((i, u['name'])
+                                       for i, u in self.users.items())
+        return self._snapshot
+
+    def changes(self, since):
+        """Return the changes to the users after version since
+
+        Returns a tuple of (user_id, name) pairs with the name of each
+        user that joined or changed, and None for those that left.  Gives
+        None if the changes since that version are no longer logged.
+        """
+        if not self._base <= since <= self.version:
+            return None
+
+        changed = {}
+        for version, user_id, name in reversed(self._log):
+            if version <= since:
+                break
+            changed.setdefault(user_id, name)
+
+        return tuple(changed.items())
 
     def _bridge_join(self, bridge_id):
         if bridge_id in self.bridges:
@@ -17,11 +67,12 @@ class BridgeChannel:
         self.bridges.add(bridge_id)
 
     def _bridge_leave(self, bridge_id):
-        bridge_users = [(i, u) for i, u in self.users.items()
-                            if u['bridge_id'] == bridge_id]
+        user_ids = tuple(i for i, u in self.users.items()
+                             if u['bridge_id'] == bridge_id)
 
-        for user_id, user in bridge_users:
-            event = Event(self, self._manager, 'user_leave', id(self), user_id)
+        if user_ids:
+            event = Event(self, self._manager, Name.user_leave_bulk,
+                          id(self), user_ids)
             self._manager.events.put(event)
 
         self.bridges.remove(bridge_id)
@@ -31,107 +82,286 @@ class BridgeChannel:
             raise ValueError("user already joined")
 
         self.users[user_id] = {"name": name, "bridge_id": bridge_id}
+        self._commit(((user_id, name),))
+
+    def _user_join_bulk(self, users, bridge_id):
+        user_ids = {i for i, n in users}
+        if len(user_ids) != len(users) or not user_ids.isdisjoint(self.users):
+            raise ValueError("user already joined")
+
+        for user_id, name in users:
+            self.users[user_id] = {"name": name, "bridge_id": bridge_id}
+        self._commit(users)
 
     def _user_update(self, user_id, name):
         self.users[user_id]["name"] = name
+        self._commit(((user_id, name),))
 
     def _user_leave(self, user_id):
         del self.users[user_id]
+        self._commit(((user_id, None),))
+
+    def _user_leave_bulk(self, user_ids):
+        """Remove users, returns the ids of the bridges they came from"""
+        unique = set(user_ids)
+        if len(unique) != len(user_ids) or not unique.issubset(self.users):
+            raise ValueError("user not joined")
+
+        bridge_ids = [self.users.pop(i)['bridge_id'] for i in user_ids]
+        self._commit((i, None) for i in user_ids)
+        return bridge_ids
 
 class BridgeManager:
-    def __init__(self, config):
+    # Events that are not dispatched until all partitions have drained
+    _barrier_events = frozenset((Name.shutdown, Name.detach, Name.exception))
+
+    def __init__(self, config, *, batch_size=1, inbox_size=None,
+                 partitions=None):
+        if inbox_size is not None and partitions is not None:
+            raise ValueError("inbox_size and partitions are exclusive")
+
         self.config = config
-        self.events = queue.Queue()
-        self._bridges = {"manager": self}
-        self._channels = {}
+        self.events = EventQueue()
+        self.batch_size = batch_size
+        self.inbox_size = inbox_size
+        self._pool = None
+        if partitions is not None:
+            self._pool = ChannelPartitions(self, partitions)
+        self._running = True
+        self._bridges = Registry(manager=self)
+        self._channels = Registry()
+        self._outlets = {id(self): self}
+        self._workers = {}
+        self._routes = {id(self): ('bridge', (self,))}
+        self._versions = itertools.count(1)
+        self._user_refs = collections.Counter()
+        self._user_channels = {}
+        self._bridge_users = collections.Counter()
+        self._all_channels = None
+        self._all_users = None
         self._eavesdropper = None
+        self._ev_table = handler_table(self, '_ev_')
+        self._tr_table = handler_table(self, '_tr_')
+        self._commands = commands(type(self), '_')
+
+    @property
+    def bridges(self):
+        return self._bridges
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def handlers(self):
+        return self._ev_table
+
+    def event_handlers(self):
+        """Return a dict of event name to names of bridges handling it"""
+        handled = collections.defaultdict(list)
+        for name, bridge in self._bridges.items():
+            for event_name in bridge.handlers:
+                handled[event_name].append(name)
+
+        return dict(handled)
+
+    def inbox_depths(self):
+        """Return a dict of bridge name to events waiting in its inbox"""
+        return {name: self._workers[id(bridge)].depth
+                    for name, bridge in self._bridges.items()
+                        if id(bridge) in self._workers}
+
+    def inbox_shed(self):
+        """Return a dict of bridge name to messages its inbox dropped"""
+        return {name: self._workers[id(bridge)].shed
+                    for name, bridge in self._bridges.items()
+                        if id(bridge) in self._workers
+                            and self._workers[id(bridge)].shed}
 
     def attach(self, name, bridge):
         assert name not in self._bridges, \
             "bridge '%s' is already attached!" % name
 
         self._bridges[name] = bridge
+        outlet = self._make_outlet(bridge)
+        if outlet is not bridge:
+            self._workers[id(bridge)] = outlet
+
+        self._outlets[id(bridge)] = outlet
+        self._routes[id(bridge)] = ('bridge', (outlet,))
         bridge.register(self)
 
+    def _make_outlet(self, bridge):
+        if self.inbox_size is not None:
+            return BridgeWorker(self, bridge, self.inbox_size,
+                                self.config.get('inbox_timeout', 1))
+
+        return bridge
+
     def detach(self, name):
         assert name in self._bridges, "bridge '%s' is not attached!" % name
         self._bridges[name].deregister()
 
     def _tr_detach(self, event):
-        name = self._bridge_name(event.source_id)
+        name = self._bridges.name_of(event.source_id)
 
-        turned_empty = []
+        left = []
         for channel_name, channel in self._channels.items():
             if event.source_id in channel.bridges:
                 channel._bridge_leave(event.source_id)
-                if not len(channel.bridges):
-                    turned_empty.append(channel_name)
-
-        for channel_name in turned_empty:
-            del self._channels[channel_name]
+                left.append(channel_name)
 
         del self._bridges[name]
-        self._running = len(self._bridges) > 1
-        return True
+        del self._routes[event.source_id]
+        del self._outlets[event.source_id]
+        if event.source_id in self._workers:
+            self._workers.pop(event.source_id).stop()
 
-    def _bridge_name(self, bridge_id):
-        for name, bridge in self._bridges.items():
-            if id(bridge) == bridge_id:
-                return name
-        else:
-            raise KeyError("no bridge with id %s is attached" % bridge_id)
+        self._all_channels = self._all_users = None
 
-    def _channel_name(self, channel_id):
-        for name, channel in self._channels.items():
-            if id(channel) == channel_id:
-                return name
-        else:
-            raise KeyError("no channel with id %s is attached" % channel_id)
+        for channel_name in left:
+            channel = self._channels[channel_name]
+            if len(channel.bridges):
+                self._route_channel(channel)
+            else:
+                self._drop_channel(channel_name)
 
-    def _ev_channel_join(self, event, name):
+        self._running = len(self._bridges) > 1
+        return True
+
+    def _route_channel(self, channel):
+        channel.destinations = tuple(o for i, o in self._outlets.items()
+                                         if i in channel.bridges)
+        self._routes[id(channel)] = ('channel', channel.destinations)
+        self._all_channels = None
+
+    def _drop_channel(self, name):
+        channel = self._channels.pop(name)
+        del self._routes[id(channel)]
+        self._all_channels = None
+
+    def _route_user_join(self, user_id, bridge_id, channel_id):
+        if not self._user_refs[user_id]:
+            kind, bridges = self._routes[bridge_id]
+            self._routes[user_id] = ('user', bridges)
+            self._user_channels[user_id] = channel_id
+        self._user_refs[user_id] += 1
+
+        if not self._bridge_users[bridge_id]:
+            self._all_users = None
+        self._bridge_users[bridge_id] += 1
+
+    def _route_user_leave(self, user_id, bridge_id):
+        self._user_refs[user_id] -= 1
+        if not self._user_refs[user_id]:
+            del self._user_refs[user_id]
+            del self._routes[user_id]
+            del self._user_channels[user_id]
+
+        self._bridge_users[bridge_id] -= 1
+        if not self._bridge_users[bridge_id]:
+            del self._bridge_users[bridge_id]
+            self._all_users = None
+
+    def _fanout_all_channels(self):
+        if self._all_channels is None:
+            channels = self._channels.values()
+            bridge_ids = {i for c in channels for i in c.bridges}
+            self._all_channels = tuple(o for i, o in self._outlets.items()
+                                           if i in bridge_ids)
+        return self._all_channels
+
+    def _fanout_all_users(self):
+        if self._all_users is None:
+            self._all_users = tuple(o for i, o in self._outlets.items()
+                                        if i in self._bridge_users)
+        return self._all_users
+
+    def _ev_channel_join(self, event, name, since=None):
         try:
             channel = self._channels[name]
         except KeyError:
             channel = self._channels[name] = BridgeChannel(self)
 
-        bridge_id, users = event.source_id, channel.users.copy()
-        self._send_event(bridge_id, 'channel_add', id(channel), name, users)
+        # A bridge that has seen the channel before gets what changed
+        # since, unless that is no longer logged or the roster is smaller.
+        bridge_id, users = event.source_id, channel.snapshot()
+        changes = None if since is None else channel.changes(since)
+        if changes is not None and len(changes) <= len(users):
+            self._send_event(bridge_id, Name.channel_add, id(channel), name,
+                             changes, version=channel.version, since=since)
+        else:
+            self._send_event(bridge_id, Name.channel_add, id(channel), name,
+                             users, version=channel.version)
         channel._bridge_join(bridge_id)
+        self._route_channel(channel)
 
     def _ev_channel_leave(self, event, name):
         self._channels[name]._bridge_leave(event.source_id)
         channel = self._channels[name]
-        self._send_event(event.source_id, 'channel_remove', id(channel))
+        self._send_event(event.source_id, Name.channel_remove, id(channel))
 
         if not len(self._channels[name].bridges):
-            del self._channels[name]
+            self._drop_channel(name)
+        else:
+            self._route_channel(channel)
 
     def _ev_user_join(self, event, channel_id, user_id, name):
-        channel_name = self._channel_name(channel_id)
+        channel = self._channels.by_id(channel_id)
+
+        channel._user_join(user_id, name, event.source_id)
+        self._route_user_join(user_id, event.source_id, channel_id)
+        self._send_event(channel_id, Name.user_add, user_id, name,
+                         version=channel.version)
+
+    def _ev_user_join_bulk(self, event, channel_id, users):
+        channel = self._channels.by_id(channel_id)
+        users = tuple(map(tuple, users))
+        if not users:
+            return
 
-        self._send_event(channel_id, 'user_add', user_id, name)
-        self._channels[channel_name]._user_join(user_id, name, event.source_id)
+        channel._user_join_bulk(users, event.source_id)
+        for user_id, name in users:
+            self._route_user_join(user_id, event.source_id, channel_id)
+        self._send_event(channel_id, Name.user_add_bulk, users,
+                         version=channel.version)
 
     def _ev_user_change(self, event, channel_id, user_id, name):
-        channel_name = self._channel_name(channel_id)
+        channel = self._channels.by_id(channel_id)
 
-        self._send_event(channel_id, 'user_update', user_id, name)
-        self._channels[channel_name]._user_update(user_id, name)
+        channel._user_update(user_id, name)
+        self._send_event(channel_id, Name.user_update, user_id, name,
+                         version=channel.version)
 
     def _ev_user_leave(self, event, channel_id, user_id):
-        channel_name = self._channel_name(channel_id)
+        channel = self._channels.by_id(channel_id)
+
+        bridge_id = channel.users[user_id]['bridge_id']
+        channel._user_leave(user_id)
+        self._route_user_leave(user_id, bridge_id)
+        self._send_event(channel_id, Name.user_remove, user_id,
+                         version=channel.version)
+
+    def _ev_user_leave_bulk(self, event, channel_id, user_ids):
+        channel = self._channels.by_id(channel_id)
+        user_ids = tuple(user_ids)
+        if not user_ids:
+            return
 
-        self._channels[channel_name]._user_leave(user_id)
-        self._send_event(channel_id, 'user_remove', user_id)
+        bridge_ids = channel._user_leave_bulk(user_ids)
+        for user_id, bridge_id in zip(user_ids, bridge_ids):
+            self._route_user_leave(user_id, bridge_id)
+        self._send_event(channel_id, Name.user_remove_bulk, user_ids,
+                         version=channel.version)
 
     def _tr_command(self, event, words, authority):
         if len(words) == 0:
-            self._send_event(event.source_id, 'message',
+            self._send_event(event.source_id, Name.message,
                              "error: empty command")
             return False
 
         elif words[0] not in self._bridges:
-            self._send_event(event.source_id, 'message',
+            self._send_event(event.source_id, Name.message,
                              "error: '{}' no such bridge".format(words[0]))
             return False
 
@@ -139,25 +369,18 @@ class BridgeManager:
         event.args = [words[1:], authority]
         return True
 
-    def _ev_command(self, event, command, authority):
-        if len(command) == 0:
-            self._send_event(event.source_id, 'message',
-                             "error: empty command")
-            return
+    def _tr_message(self, event, content, segments=None):
+        # Parse the mentions once here for sources that did not provide
+        # segments, rather than in every bridge rendering the message.
+        if segments is None:
+            event.kwargs = dict(event.kwargs, segments=parse(content))
+        return True
 
-        handler = getattr(self, '_{}'.format(command[0]), None)
-        if is_command(handler):
-            try:
-                response = handler(*command[1:])
-            except Exception as e:
-                self._send_event(event.source_id, 'message',
-                                 "error: {}".format(e))
-            else:
-                if response is not None:
-                    self._send_event(event.source_id, 'message', response)
-        else:
-            self._send_event(event.source_id, 'message', "error: '{}' "
-                             "unkown command".format(command[0]))
+    _tr_action = _tr_message
+
+    def _ev_command(self, event, command, authority):
+        run_command(self._commands, self, command,
+                    partial(self._send_event, event.source_id, Name.message))
 
     def _ev_exception(self, event, exception):
         raise exception
@@ -166,86 +389,165 @@ class BridgeManager:
         self.events.put(Event(self, target, name, *args, **kwargs))
 
     def _dispatch(self, event):
-        handler = getattr(self, '_ev_{}'.format(event.name), None)
+        handler = self._ev_table.get(event.name)
         if handler is not None:
             handler(event, *event.args, **event.kwargs)
 
     def _translate(self, event):
-        handler = getattr(self, '_tr_{}'.format(event.name), None)
+        handler = self._tr_table.get(event.name)
         if handler is not None:
             return handler(event, *event.args, **event.kwargs)
         else:
             return True
 
     def once(self):
-        event = self.events.get()
+        self._process(self.events.get())
+
+    def once_batch(self):
+        for event in self.events.get_batch(self.batch_size):
+            self._process(event)
+            if not self._running:
+                break
+
+    def _process(self, event):
+        if self._pool is not None and event.name in self._barrier_events:
+            self._pool.join()
+
         if self._translate(event):
             if self._eavesdropper is not None:
                 self._eavesdropper(event)
 
+            kind = None
             if event.target_id == Target.Everything:
-                bridges = self._bridges.values()
+                bridges = self._outlets.values()
 
             elif event.target_id == Target.Manager:
                 bridges = (self,)
 
             elif event.target_id == Target.AllBridges:
-                bridges = (b for b in self._bridges.values() if b is not self)
+                bridges = (o for o in self._outlets.values() if o is not self)
 
             elif event.target_id == Target.AllChannels:
-                channels = self._channels.values()
-                bridge_ids = {i for c in channels for i in c.bridges}
-                bridges = (b for b in self._bridges.values()
-                               if id(b) in bridge_ids)
+                bridges = self._fanout_all_channels()
 
             elif event.target_id == Target.AllUsers:
-                users = (u for c in self._channels.values() for u in c.users)
-                bridge_ids = {u['bridge_id'] for u in users}
-                bridges = (b for b in self._bridges.values()
-                               if id(b) in bridge_ids)
+                bridges = self._fanout_all_users()
+
+            elif event.target_id in self._routes:
+                kind, bridges = self._routes[event.target_id]
 
             else:
-                for bridge in self._bridges.values():
-                    if id(bridge) == event.target_id:
-                        bridges = (bridge,)
-                        break
+                raise ValueError("invalid target")
 
-                else:
-                    for channel in self._channels.values():
-                        if id(channel) == event.target_id:
-                            bridges = (b for b in self._bridges.values()
-                                           if id(b) in channel.bridges)
-                            break
-
-                        elif event.target_id in channel.users:
-                            user = channel.users[event.target_id]
-                            bridges = (b for b in self._bridges.values()
-                                           if id(b) == user['bridge_id'])
-                            break
-                    else:
-                        raise ValueError("invalid target")
-
-            for bridge in bridges:
-                bridge._dispatch(event)
+            if self._pool is not None:
+                self._partition(event, kind, bridges)
+            else:
+                for bridge in bridges:
+                    bridge._dispatch(event)
+
+    def _partition(self, event, kind, bridges):
+        # Events go in the lane of the channel they are about, keeping
+        # membership changes in order with the channel's messages.  That
+        # is the channel a bridge is told it joined or left, and for
+        # messages to a user the channel the user first joined.  The
+        # manager handles its own events here.
+        if kind == 'channel':
+            channel_id = event.target_id
+        elif kind == 'user':
+            channel_id = self._user_channels[event.target_id]
+        elif event.name in (Name.channel_add, Name.channel_remove):
+            channel_id = event.args[0]
+        else:
+            channel_id = None
+
+        for bridge in bridges:
+            if bridge is self:
+                self._dispatch(event)
+            else:
+                self._pool.put(event, bridge, channel_id)
 
     def run(self):
         self._running = True
         try:
             while self._running:
-                self.once()
+                if self.batch_size == 1:
+                    self.once()
+                else:
+                    self.once_batch()
         finally:
             self.terminate()
 
     def terminate(self):
+        for worker in self._workers.values():
+            worker.stop()
+
+        if self._pool is not None:
+            self._pool.stop()
+
+        # Bridges are only terminated once their worker has finished with
+        # the events queued for them, a bridge stuck in a handler is left
+        # alone rather than terminated from under it.
+        deadline = monotonic() + self.config.get('stop_timeout', 5)
+        stuck = set()
+        for bridge_id, worker in self._workers.items():
+            if not worker.join(max(0, deadline - monotonic())):
+                stuck.add(bridge_id)
+
         while True:
             try:
                 name, bridge = self._bridges.popitem()
             except KeyError:
                 break
 
-            if bridge is not self:
+            if id(bridge) in stuck:
+                logging.error("Bridge %s is stuck, not terminating it", name)
+            elif bridge is not self:
                 bridge.terminate()
 
+    @command
+    def _handlers(self, *event_names):
+        handled = self.event_handlers()
+        event_names = event_names or sorted(handled)
+        return '\n'.join('{}: {}'.format(n, ', '.join(handled.get(n, ())))
+                             for n in event_names)
+
+    @command
+    def _inboxes(self):
+        depths = self.inbox_depths()
+        if not depths:
+            return "per-bridge inboxes are not enabled"
+
+        shed = self.inbox_shed()
+        return ', '.join('{}: {}'.format(n, d) if n not in shed else
+                         '{}: {} ({} dropped)'.format(n, d, shed[n])
+                             for n, d in depths.items())
+
+    @command
+    def _partitions(self):
+        if self._pool is None:
+            return "bridge partitions are not enabled"
+
+        depths = []
+        for (bridge_id, channel_id), depth in self._pool.depths.items():
+            lane = self._bridges.name_of(bridge_id, bridge_id)
+            if channel_id is not None:
+                channel = self._channels.name_of(channel_id, channel_id)
+                lane = '{} #{}'.format(lane, channel)
+            depths.append('{}: {}'.format(lane, depth))
+
+        return ', '.join(depths) or "no events waiting"
+
+    @command
+    def _help(self, *names):
+        lines = []
+        for name in names or sorted(self._commands):
+            if name in self._commands:
+                lines.append(self._commands[name].usage(name))
+            else:
+                lines.append("error: '{}' unknown command".format(name))
+
+        return '\n'.join(lines)
+
     @command
     def _shutdown(self):
-        self._send_event(Target.AllBridges, 'shutdown')
+        self._send_event(Target.AllBridges, Name.shutdown)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from inspect import iscoroutinefunction
+
+from . import BridgeManager
+from .dispatch import BridgeWorker
+from .event import Event, Name, Target, handler_table
+
+
+class _LoopQueue:
+    """Thread-safe event queue feeding an asyncio.Queue
+
+    Bridges put events from any thread, the manager awaits them on its
+    event loop.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+
+    def put(self, event):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    def empty(self):
+        return self._queue.empty()
+
+    async def get(self):
+        return await self._queue.get()
+
+    async def get_batch(self, limit=None):
+        batch = [await self._queue.get()]
+        while not self._queue.empty() and (limit is None or
+                                           len(batch) < limit):
+            batch.append(self._queue.get_nowait())
+
+        return batch
+
+
+class AsyncBridgeWorker:
+    """Dispatches events to a bridge from a task on the manager's loop
+
+    The asyncio counterpart of BridgeWorker, used for bridges that are
+    safe to run on the event loop.  Coroutine handlers are awaited in
+    order, so a bridge awaiting in a handler only delays its own events.
+    """
+
+    # The inbox is unbounded, nothing is dropped
+    shed = 0
+
+    def __init__(self, manager, bridge):
+        self.manager = manager
+        self.bridge = bridge
+        self.inbox = asyncio.Queue()
+        self.task = asyncio.run_coroutine_threadsafe(self.run(), manager.loop)
+
+    @property
+    def depth(self):
+        return self.inbox.qsize()
+
+    def _dispatch(self, event):
+        self.inbox.put_nowait(event)
+
+    def stop(self):
+        self.inbox.put_nowait(None)
+
+    def join(self, timeout=None):
+        # The task runs on the loop the manager terminates bridges from,
+        # so it cannot be waited on there and never runs alongside it.
+        return True
+
+    async def run(self):
+        while True:
+            event = await self.inbox.get()
+            if event is None:
+                break
+
+            try:
+                await self.bridge._dispatch_async(event)
+            except Exception as e:
+                logging.exception("Error dispatching %s", event)
+                self.manager.events.put(Event(self.bridge, Target.Manager,
+                                              Name.exception, e))
+
+
+def _is_asynchronous(bridge):
+    if bridge.asynchronous:
+        return True
+
+    handlers = handler_table(bridge, 'ev_').values()
+    return any(iscoroutinefunction(h) for h in handlers)
+
+
+class AsyncBridgeManager(BridgeManager):
+    """Bridge manager running on an asyncio event loop
+
+    Events are read from an asyncio.Queue by a coroutine instead of a
+    blocking thread.  Bridges that are asynchronous, either by setting
+    the asynchronous attribute or by implementing coroutine handlers,
+    are dispatched by a task on the manager's loop and may share it.
+    Other bridges are run through a BridgeWorker thread, which keeps
+    their blocking handlers off the loop.
+    """
+
+    def __init__(self, config, *, loop=None, batch_size=1):
+        BridgeManager.__init__(self, config, batch_size=batch_size)
+        self.loop = loop if loop is not None else asyncio.new_event_loop()
+        self.events = _LoopQueue(self.loop)
+
+    def _make_outlet(self, bridge):
+        if _is_asynchronous(bridge):
+            return AsyncBridgeWorker(self, bridge)
+
+        # A bounded inbox would block the event loop when full
+        return BridgeWorker(self, bridge)
+
+    async def run_async(self):
+        self._running = True
+        try:
+            while self._running:
+                for event in await self.events.get_batch(self.batch_size):
+                    self._process(event)
+                    if not self._running:
+                        break
+        finally:
+            self.terminate()
+
+            # Give tasks started by terminating bridges a chance to finish
+            current = asyncio.current_task()
+            pending = [t for t in asyncio.all_tasks()
+                           if t is not current and not t.done()]
+            if pending:
+                await asyncio.wait(pending, timeout=5)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.run_async())
+        finally:
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+
+            gathered = asyncio.gather(*pending, return_exceptions=True)
+            self.loop.run_until_complete(gathered)
@@ -1,4 +1,7 @@
-from ..event import Event, Target
+from inspect import isawaitable, signature
+from types import MappingProxyType
+
+from ..event import Event, Name, Target, handler_table
 
 _target_name = {
     id(Target.Everything): "Everything",
@@ -8,19 +11,49 @@ _target_name = {
     id(Target.AllUsers): "All Users",
 }
 
+# Keyword arguments added to events after handlers for them were written
+_added_kwargs = {
+    Name.message: 'segments',
+    Name.action: 'segments',
+    Name.user_add: 'version',
+    Name.user_add_bulk: 'version',
+    Name.user_update: 'version',
+    Name.user_remove: 'version',
+    Name.user_remove_bulk: 'version',
+}
+
+def _takes(handler, kwarg):
+    return any(p.name == kwarg or p.kind == p.VAR_KEYWORD
+                   for p in signature(handler).parameters.values())
+
+def _without(handler, kwarg):
+    def wrapper(event, *args, **kwargs):
+        kwargs.pop(kwarg, None)
+        return handler(event, *args, **kwargs)
+    return wrapper
+
 class Channel:
-    __slots__ = ('_id', '_name', '_users')
+    __slots__ = ('_id', '_name', '_users', '_version')
 
-    def __init__(self, id, name, users):
+    def __init__(self, id, name, users, version=None):
         self._id = id
         self._name = name
         self._users = {}
+        self._version = version
 
-        for user_id, user in users.items():
-            self._users[user_id] = User(user_id, user['name'])
+        for user_id, name in users:
+            self._users[user_id] = User(user_id, name)
 
     def copy(self):
-        return Channel(self._id, self._name, self._users.copy())
+        users = ((u.id, u.name) for u in self._users.values())
+        return Channel(self._id, self._name, users, self._version)
+
+    def _apply(self, changes):
+        for user_id, name in changes:
+            if name is None:
+                self._users.pop(user_id, None)
+            else:
+                self._users[user_id] = User(user_id, name)
 
     @property
     def id(self):
@@ -34,6 +67,11 @@ class Channel:
     def users(self):
         return self._users.values()
 
+    @property
+    def version(self):
+        """Membership version this channel was last synced at, or None"""
+        return self._version
+
 
 class User:
     __slots__ = ('_id', '_name')
@@ -55,10 +93,25 @@ class User:
 
 
 class BaseBridge:
+    # Set to True by bridges that are safe to dispatch from the event loop
+    # of an AsyncBridgeManager.  Bridges with coroutine handlers are always
+    # dispatched on the loop.
+    asynchronous = False
+
+    # Set to True by bridges whose handlers may be called from several
+    # threads at once for different channels, by a BridgeManager with
+    # partitions.  The channels dict is replaced rather than changed, so
+    # it can be iterated while another channel is added or removed.
+    channel_safe = False
+
     def __init__(self, config):
         self.config = config
         self.channels = {}
 
+        # Channels left are kept by name, so that rejoining them only
+        # needs the membership changes since.
+        self._stale = {}
+
     def _assert_registered(self):
         if not self.is_registered:
             raise RuntimeError("this {} is not registered".format(type(self)))
@@ -69,6 +122,17 @@ class BaseBridge:
                                "".format(type(self)))
 
         self._manager = manager
+        self._ev_table = handler_table(self, 'ev_')
+
+        # Handlers written before an event carried a keyword argument are
+        # called without it.
+        table = dict(self._ev_table)
+        for name, kwarg in _added_kwargs.items():
+            if name in table and not _takes(table[name], kwarg):
+                table[name] = _without(table[name], kwarg)
+        self._ev_table = MappingProxyType(table)
+
+        self._on_event = getattr(self, 'on_event', None)
         self._hook('on_register')
 
     def deregister(self):
@@ -78,40 +142,96 @@ class BaseBridge:
         self.detach()
 
     def detach(self):
-        self.send_event(self, Target.Manager, 'detach')
+        self.send_event(self, Target.Manager, Name.detach)
         del self._manager
 
     @property
     def is_registered(self):
         return hasattr(self, "_manager")
 
-    def ev_channel_add(self, event, channel_id, name, users):
-        self.channels[channel_id] = channel = Channel(channel_id, name, users)
+    @property
+    def handlers(self):
+        return self._ev_table
+
+    def join_channel(self, name):
+        """Ask the manager to join the channel called name"""
+        channel = self._find_channel(name) or self._stale.get(name)
+        if channel is not None and channel.version is not None:
+            self.send_event(self, Target.Manager, Name.channel_join, name,
+                            since=channel.version)
+        else:
+            self.send_event(self, Target.Manager, Name.channel_join, name)
+
+    def ev_channel_add(self, event, channel_id, name, users, version=None,
+                       since=None):
+        # Drop what is known of the channel from an earlier join, which
+        # users holds the changes to if since is given.
+        old = self._stale.pop(name, None)
+        channels = dict(self.channels)
+        current = self._find_channel(name)
+        if current is not None:
+            del channels[current.id]
+            old = current
+
+        if since is not None:
+            channel = Channel(channel_id, name, (), version)
+            channel._users = dict(old._users)
+            channel._apply(users)
+        else:
+            channel = Channel(channel_id, name, users, version)
+
+        channels[channel_id] = channel
+        self.channels = channels
         self._hook('on_channel_add', channel)
 
     def ev_channel_remove(self, event, channel_id):
-        channel = self.channels[channel_id]
-        del self.channels[channel_id]
+        channels = dict(self.channels)
+        channel = channels.pop(channel_id)
+        self.channels = channels
+        self._stale[channel.name] = channel
         self._hook('on_channel_remove', channel)
 
-    def ev_user_add(self, event, user_id, name):
+    def _find_channel(self, name):
+        for channel in self.channels.values():
+            if channel.name == name:
+                return channel
+
+    def ev_user_add(self, event, user_id, name, version=None):
         channel = self.channels[event.target_id]
+        channel._version = version
         channel._users[user_id] = user = User(user_id, name)
         self._hook('on_user_add', channel, user)
 
-    def ev_user_update(self, event, user_id, name):
+    def ev_user_add_bulk(self, event, users, version=None):
         channel = self.channels[event.target_id]
+        channel._version = version
+        added = []
+        for user_id, name in users:
+            channel._users[user_id] = user = User(user_id, name)
+            added.append(user)
+        self._hook_bulk('on_user_add', channel, added)
+
+    def ev_user_update(self, event, user_id, name, version=None):
+        channel = self.channels[event.target_id]
+        channel._version = version
         after = channel._users[user_id]
         before = after.copy()
         after._name = name
         self._hook('on_user_update', channel, before, after)
 
-    def ev_user_remove(self, event, user_id):
+    def ev_user_remove(self, event, user_id, version=None):
         channel = self.channels[event.target_id]
+        channel._version = version
         user = channel._users[user_id]
         del self.channels[event.target_id]._users[user_id]
         self._hook('on_user_remove', channel, user)
 
+    def ev_user_remove_bulk(self, event, user_ids, version=None):
+        channel = self.channels[event.target_id]
+        channel._version = version
+        removed = [channel._users.pop(i) for i in user_ids]
+        self._hook_bulk('on_user_remove', channel, removed)
+
     def get_channel_by_name(self, name):
         for channel in self.channels.values():
             if channel.name == name:
@@ -136,15 +256,15 @@ class BaseBridge:
         if item_id in self.channels:
             return '#{}'.format(self.channels[item_id].name)
 
-        try:
-            return '[{}]'.format(self._manager._bridge_name(item_id))
-        except (KeyError, AttributeError):
-            pass
+        manager = getattr(self, '_manager', None)
+        if manager is not None:
+            name = manager.bridges.name_of(item_id, None)
+            if name is not None:
+                return '[{}]'.format(name)
 
-        try:
-            return '#{}'.format(self._manager._channel_name(item_id))
-        except (KeyError, AttributeError):
-            pass
+            name = manager.channels.name_of(item_id, None)
+            if name is not None:
+                return '#{}'.format(name)
 
         try:
             return '<{}>'.format(self.get_user(item_id).name)
@@ -164,12 +284,35 @@ class BaseBridge:
         if handler is not None:
             handler(*args, **kwargs)
 
+    def _hook_bulk(self, name, channel, users):
+        # Bridges without the _bulk variant of a hook get it once per user
+        handler = getattr(self, name + '_bulk', None)
+        if handler is not None:
+            handler(channel, users)
+        else:
+            for user in users:
+                self._hook(name, channel, user)
+
     def _dispatch(self, event):
-        self._hook('on_event', event)
-        handler = getattr(self, 'ev_{}'.format(event.name), None)
+        if self._on_event is not None:
+            self._on_event(event)
+
+        handler = self._ev_table.get(event.name)
         if handler is not None:
             handler(event, *event.args, **event.kwargs)
 
+    async def _dispatch_async(self, event):
+        if self._on_event is not None:
+            result = self._on_event(event)
+            if isawaitable(result):
+                await result
+
+        handler = self._ev_table.get(event.name)
+        if handler is not None:
+            result = handler(event, *event.args, **event.kwargs)
+            if isawaitable(result):
+                await result
+
     def send_event(self, source, target, name, *args, **kwargs):
         self._assert_registered()
         self._manager.events.put(Event(source, target, name, *args, **kwargs))
@@ -1,14 +1,15 @@
-import re
 import threading
 
 from . import BaseBridge
-from ..event import Target
-from ..cmdsys import split, command, is_command
+from ..event import Name, Target
+from ..cmdsys import split, command, commands, run_command
+from ..segments import parse, render
 
 
 class ConsoleBridge(BaseBridge):
     def __init__(self, config):
         BaseBridge.__init__(self, config)
+        self._commands = commands(type(self))
         self._thread = threading.Thread(target=self.run, daemon=True)
 
     def on_register(self):
@@ -26,24 +27,34 @@ class ConsoleBridge(BaseBridge):
     def on_user_add(self, channel, user):
         print('#{}: {} joined'.format(channel.name, user.name))
 
+    def on_user_add_bulk(self, channel, users):
+        names = ', '.join(u.name for u in users)
+        print('#{}: {} joined'.format(channel.name, names))
+
     def on_user_update(self, channel, before, after):
         print('#{}: {} -> {}'.format(channel.name, before.name, after.name))
 
     def on_user_remove(self, channel, user):
         print('#{}: {} left'.format(channel.name, user.name))
 
-    def decode_mentions(self, content):
-        def replace(match):
-            user_id = int(match.group(1))
-            try:
-                return '@{}'.format(self.get_user(user_id).name)
-            except KeyError:
-                return match.group()
+    def on_user_remove_bulk(self, channel, users):
+        names = ', '.join(u.name for u in users)
+        print('#{}: {} left'.format(channel.name, names))
+
+    def mention(self, user_id):
+        try:
+            return '@{}'.format(self.get_user(user_id).name)
+        except KeyError:
+            return None
 
-        return re.sub(r'<\[@([0-9]+)\]>', replace, content)
+    def decode_mentions(self, content, segments=None):
+        if segments is None:
+            segments = parse(content)
 
-    def ev_message(self, event, content):
-        content = self.decode_mentions(content)
+        return render(segments, self.mention)
+
+    def ev_message(self, event, content, segments=None):
+        content = self.decode_mentions(content, segments)
 
         source = self.name(event.source_id)
 
@@ -54,8 +65,8 @@ class ConsoleBridge(BaseBridge):
 
         print('{}{} {}'.format(target, source, content))
 
-    def ev_action(self, event, content):
-        content = self.decode_mentions(content)
+    def ev_action(self, event, content, segments=None):
+        content = self.decode_mentions(content, segments)
 
         try:
             source = '* {}'.format(self.get_user(event.source_id).name)
@@ -80,18 +91,19 @@ class ConsoleBridge(BaseBridge):
                 if not len(words):
                     continue
 
-                func = getattr(self, words[0], None)
-                if is_command(func):
-                    try:
-                        func(*words[1:])
-                    except Exception as e:
-                        print("{}: {}".format(e.__class__.__name__, e))
-                else:
-                    print("error: '{}' unknown command".format(words[0]))
+                run_command(self._commands, self, words, print)
+
+    @command
+    def help(self, *names):
+        for name in names or sorted(self._commands):
+            if name in self._commands:
+                print(self._commands[name].usage())
+            else:
+                print("error: '{}' unknown command".format(name))
 
     @command
     def bridge(self, *words):
-        self.send_event(self, Target.Manager, 'command', words, 'console')
+        self.send_event(self, Target.Manager, Name.command, words, 'console')
 
     @command
     def manager(self, *words):
@@ -114,18 +126,18 @@ class ConsoleBridge(BaseBridge):
     def say(self, channel_name, *content):
         channel = self.get_channel_by_name(channel_name)
         content = ' '.join(content)
-        self.send_event(self, channel.id, 'message', content)
+        self.send_event(self, channel.id, Name.message, content)
 
     @command
     def action(self, channel_name, *content):
         channel = self.get_channel_by_name(channel_name)
         content = ' '.join(content)
-        self.send_event(self, channel.id, 'action', content)
+        self.send_event(self, channel.id, Name.action, content)
 
     @command
     def broadcast(self, *content):
         content = ' '.join(content)
-        self.send_event(self, Target.AllChannels, 'message', content)
+        self.send_event(self, Target.AllChannels, Name.message, content)
 
     @command
     def set(self, prop):
@@ -138,11 +150,11 @@ class ConsoleBridge(BaseBridge):
 
     @command
     def join(self, channel_name):
-        self.send_event(self, Target.Manager, 'channel_join', channel_name)
+        self.join_channel(channel_name)
 
     @command
     def leave(self, channel_name):
-        self.send_event(self, Target.Manager, 'channel_leave', channel_name)
+        self.send_event(self, Target.Manager, Name.channel_leave, channel_name)
 
     def on_eavesdrop(self, event):
         args = map(self.name, event.args)
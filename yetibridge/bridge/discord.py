@@ -3,7 +3,8 @@ import re
 import threading
 import time
 from asyncio import run_coroutine_threadsafe, get_event_loop_policy, \
-                    new_event_loop, sleep
+                    new_event_loop, sleep, CancelledError
+from inspect import iscoroutinefunction
 
 import aiohttp
 import discord
@@ -12,11 +13,17 @@ from discord.utils import get
 import websockets
 
 from . import BaseBridge
-from ..event import Event, Target
+from ..event import Event, Name, Target
 from ..backoff import ExponentialBackoff
+from ..segments import MENTION, TEXT, from_text, join, parse, render
+
+
+_mention = re.compile(r'<@!?([0-9]+)>')
 
 
 class DiscordBridge(BaseBridge):
+    asynchronous = True
+
     def __init__(self, config):
         BaseBridge.__init__(self, config)
         self.users = {}
@@ -27,44 +34,70 @@ class DiscordBridge(BaseBridge):
         self.lv_thread = threading.Thread(target=self.leave_loop, daemon=True)
         self.lv_thread.start()
 
-        self.loop = loop = new_event_loop()
-        self.bridge_bot = DiscordBridgeBot(self.config, self, id(self), loop)
-
     def on_register(self):
-        self.thread = threading.Thread(target=self.run)
-        self.thread.start()
+        # Share the manager's event loop if it runs on one, in which case
+        # this bridge is dispatched from that loop and the bot is
+        # called directly instead of through thread-safe handoffs.
+        manager_loop = getattr(self._manager, 'loop', None)
+        self.shared_loop = manager_loop is not None
+        self.loop = manager_loop if self.shared_loop else new_event_loop()
+        self.bridge_bot = DiscordBridgeBot(self.config, self, id(self),
+                                           self.loop)
+
+        if self.shared_loop:
+            run_coroutine_threadsafe(self.run_async(), self.loop)
+        else:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
 
         for name in self.config['channels']:
-            self.send_event(self, Target.Manager, 'channel_join', name)
+            self.join_channel(name)
+
+    def _dispatch(self, event):
+        # Managers without an event loop dispatch from their own thread,
+        # coroutine handlers are then run to completion on the bot's loop
+        # so that they are done before the next event as well.
+        handler = self._ev_table.get(event.name)
+        if iscoroutinefunction(handler):
+            coro = handler(event, *event.args, **event.kwargs)
+            if self.thread.is_alive():
+                run_coroutine_threadsafe(coro, self.loop).result()
+            else:
+                self.loop.run_until_complete(coro)
+        else:
+            BaseBridge._dispatch(self, event)
 
-    def on_channel_add(self, channel):
-        run_coroutine_threadsafe(self.bridge_bot.add_channel(channel),
-                                 self.bridge_bot.loop).result()
+    async def ev_channel_add(self, event, channel_id, *args, **kwargs):
+        BaseBridge.ev_channel_add(self, event, channel_id, *args, **kwargs)
+        await self.bridge_bot.add_channel(self.channels[channel_id])
 
-    def on_channel_remove(self, channel):
-        run_coroutine_threadsafe(self.bridge_bot.remove_channel(channel),
-                                 self.bridge_bot.loop).result()
+    async def ev_channel_remove(self, event, channel_id):
+        channel = self.channels[channel_id]
+        BaseBridge.ev_channel_remove(self, event, channel_id)
+        await self.bridge_bot.remove_channel(channel)
 
-    def decode_mentions(self, content):
-        def replace(match):
-            user_id = int(match.group(1))
-            if user_id in self.users:
-                return '<@{}>'.format(self.users[user_id].discord_id)
-            else:
-                try:
-                    return '@{}'.format(self.get_user(user_id).name)
-                except KeyError:
-                    return match.group()
+    def mention(self, user_id):
+        if user_id in self.users:
+            return '<@{}>'.format(self.users[user_id].discord_id)
+        else:
+            try:
+                return '@{}'.format(self.get_user(user_id).name)
+            except KeyError:
+                return None
+
+    def decode_mentions(self, content, segments=None):
+        if segments is None:
+            segments = parse(content)
 
-        return re.sub(r'<\[@([0-9]+)\]>', replace, content)
+        return render(segments, self.mention)
 
-    def ev_message(self, event, content):
+    def ev_message(self, event, content, segments=None):
         if event.source_id in self.users:
             return
 
         name = self.name(event.source_id)
+        content = self.decode_mentions(content, segments)
         content = '{} {}'.format(name, content)
-        content = self.decode_mentions(content)
 
         if event.target_id in self.channels:
             channel_name = self.channels[event.target_id].name
@@ -73,7 +106,7 @@ class DiscordBridge(BaseBridge):
             for channel in self.channels.values():
                 self.bridge_bot.message(channel.name, content)
 
-    def ev_action(self, event, content):
+    def ev_action(self, event, content, segments=None):
         if event.source_id in self.users:
             return
 
@@ -82,8 +115,8 @@ class DiscordBridge(BaseBridge):
         except:
             name = self.name(event.source_id)
 
+        content = self.decode_mentions(content, segments)
         content = '* {} {}'.format(name, content)
-        content = self.decode_mentions(content)
 
         if event.target_id in self.channels:
             channel = self.channels[event.target_id]
@@ -93,35 +126,44 @@ class DiscordBridge(BaseBridge):
                 self.bridge_bot.message(channel.name, content)
 
 
-    def ev_shutdown(self, event):
-        if self.loop.is_running() and self.bridge_bot._is_ready.is_set():
-            run_coroutine_threadsafe(self.bridge_bot.close(),
-                                     self.loop).result()
+    async def ev_shutdown(self, event):
+        if self.bridge_bot._is_ready.is_set():
+            await self.bridge_bot.close()
 
         self.detach()
 
     def on_terminate(self):
         if self.loop.is_running() and self.bridge_bot._is_ready.is_set():
-            run_coroutine_threadsafe(self.bridge_bot.close(),
-                                     self.loop).result()
+            if self.shared_loop:
+                # Terminating runs on the loop, which lets pending tasks
+                # finish before it stops.
+                self.loop.create_task(self.bridge_bot.close())
+            else:
+                coro = self.bridge_bot.close()
+                run_coroutine_threadsafe(coro, self.loop).result()
 
     def run(self):
         policy = get_event_loop_policy()
         policy.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.run_async())
 
+    async def run_async(self):
         task = self.bridge_bot.keep_running(self.config['token'])
         try:
             # This should not throw any exception other than
             # the occasional KeyboardInterrupt
-            self.loop.run_until_complete(task)
+            await task
+
+        except CancelledError:
+            raise
 
         except BaseException as e:
             try:
-                self.loop.run_until_complete(self.bridge_bot.logout())
+                await self.bridge_bot.logout()
             except BaseException:
                 logging.exception("Ignoring exception while handling another")
 
-            self.send_event(self, Target.Manager, 'exception', e)
+            self.send_event(self, Target.Manager, Name.exception, e)
 
     def leave_loop(self):
         while True:
@@ -130,20 +172,24 @@ class DiscordBridge(BaseBridge):
                 self.check_user_timeouts()
 
     def check_user_timeouts(self):
-        leaving = []
+        leaving = {}
         for (discord_id, channel), timestamp in self.leaving_users.items():
             if timestamp+self.config['timeout'] < time.time():
-                leaving.append((discord_id, channel))
+                leaving.setdefault(channel, []).append(discord_id)
 
-        for discord_id, channel in leaving:
-            del self.leaving_users[(discord_id, channel)]
-            self.user_timeout(discord_id, channel)
+        # Users that timed out together leave their channel in one event
+        for channel, discord_ids in leaving.items():
+            user_ids = []
+            for discord_id in discord_ids:
+                del self.leaving_users[(discord_id, channel)]
+                user_ids.append(self.user_timeout(discord_id, channel))
+
+            self.send_event(self, Target.Manager, Name.user_leave_bulk,
+                            channel.id, tuple(user_ids))
 
     def user_timeout(self, discord_id, channel):
+        """Forget a user's presence in channel, returns the user id"""
         user_id = self.user_map[discord_id]
-        self.send_event(self, Target.Manager, 'user_leave',
-                        channel.id, user_id)
-
         user_channels = self.users[user_id].channels
         user_channels.remove(channel)
 
@@ -151,32 +197,51 @@ class DiscordBridge(BaseBridge):
             del self.users[user_id]
             del self.user_map[discord_id]
 
+        return user_id
+
     def discord_user_join(self, channel, discord_id, name):
         with self.user_lock:
-            # Discard possible pending leave for the user
-            self.leaving_users.pop((discord_id, channel), None)
+            user_id = self.join_user(channel, discord_id)
+            if user_id is not None:
+                self.send_event(self, Target.Manager, Name.user_join,
+                                channel.id, user_id, name)
 
-            if discord_id not in self.user_map:
-                user = DiscordUser(discord_id, {channel})
-                self.send_event(self, Target.Manager, 'user_join',
-                                channel.id, id(user), name)
+    def discord_users_join(self, channel, members):
+        """Join many users at once, members is a list of (id, name)"""
+        with self.user_lock:
+            users = []
+            for discord_id, name in members:
+                user_id = self.join_user(channel, discord_id)
+                if user_id is not None:
+                    users.append((user_id, name))
 
-                self.users[id(user)] = user
-                self.user_map[discord_id] = id(user)
+            if users:
+                self.send_event(self, Target.Manager, Name.user_join_bulk,
+                                channel.id, tuple(users))
 
-            else:
-                user = self.users[self.user_map[discord_id]]
-                if channel not in user.channels:
-                    self.send_event(self, Target.Manager, 'user_join',
-                                    channel.id, id(user), name)
+    def join_user(self, channel, discord_id):
+        """Track a user in channel, returns its id if it was not there"""
+        # Discard possible pending leave for the user
+        self.leaving_users.pop((discord_id, channel), None)
+
+        if discord_id not in self.user_map:
+            user = DiscordUser(discord_id, {channel})
+            self.users[id(user)] = user
+            self.user_map[discord_id] = id(user)
+            return id(user)
+
+        user = self.users[self.user_map[discord_id]]
+        if channel not in user.channels:
+            user.channels.add(channel)
+            return id(user)
 
-                    user.channels.add(channel)
+        return None
 
 
     def discord_name_change(self, channel, discord_id, new_name):
         with self.user_lock:
             if discord_id in self.user_map:
-                self.send_event(self, Target.Manager, 'user_change',
+                self.send_event(self, Target.Manager, Name.user_change,
                                 channel.id, self.user_map[discord_id],
                                 new_name)
 
@@ -187,46 +252,56 @@ class DiscordBridge(BaseBridge):
                     self.leaving_users[(discord_id, channel)] = time.time()
 
     def translate_mentions(self, content, mentions):
-        def replace(match):
+        """Returns the segments of a message with the mentions resolved"""
+        segments = []
+        pos = 0
+        for match in _mention.finditer(content):
+            segments.extend(from_text(content[pos:match.start()]))
+            pos = match.end()
+
             discord_id = match.group(1)
             if discord_id in self.user_map:
-                return '<[@{}]>'.format(self.user_map[discord_id])
+                segments.append((MENTION, self.user_map[discord_id]))
             else:
                 user = get(mentions, id=discord_id)
                 if user:
-                    return '@{}'.format(user.name)
+                    segments.append((TEXT, '@{}'.format(user.name)))
                 else:
-                    return match.group()
+                    segments.append((TEXT, match.group()))
+
+        segments.extend(from_text(content[pos:]))
+        return tuple(segments)
 
-        return re.sub(r'<@!?([0-9]+)>', replace, content)
+    def send_message(self, source_id, target_id, name, content, mentions):
+        segments = self.translate_mentions(content, mentions)
+        self.send_event(source_id, target_id, name, join(segments),
+                        segments=segments)
 
     def discord_channel_message(self, channel, discord_id, content, mentions):
         with self.user_lock:
             if discord_id in self.user_map:
                 user_id = self.user_map[discord_id]
-                content = self.translate_mentions(content, mentions)
-                self.send_event(user_id, channel.id, 'message', content)
+                self.send_message(user_id, channel.id, Name.message, content,
+                                  mentions)
 
     def discord_channel_action(self, channel, discord_id, content, mentions):
         with self.user_lock:
             if discord_id in self.user_map:
                 user_id = self.user_map[discord_id]
-                content = self.translate_mentions(content[1:-1], mentions)
-                self.send_event(user_id, channel.id, 'action', content)
+                self.send_message(user_id, channel.id, Name.action,
+                                  content[1:-1], mentions)
 
     def discord_private_message(self, user_id, discord_id, content, mentions):
         with self.user_lock:
             if discord_id in self.user_map:
-                content = self.translate_mentions(content, mentions)
-                self.send_event(self.user_map[discord_id], user_id, 'message',
-                                content)
+                self.send_message(self.user_map[discord_id], user_id,
+                                  Name.message, content, mentions)
 
     def discord_private_action(self, user_id, discord_id, content, mentions):
         with self.user_lock:
             if discord_id in self.user_map:
-                content = self.translate_mentions(content[1:-1], mentions)
-                self.send_event(self.user_map[discord_id], user_id, 'message',
-                                content)
+                self.send_message(self.user_map[discord_id], user_id,
+                                  Name.message, content[1:-1], mentions)
 
 
 class DiscordUser:
@@ -298,11 +373,17 @@ class DiscordBot(Client):
     def action(self, target_id, content):
         target_id = self.config['channels'][target_id]
         content = '_{}_'.format(content) # Yes, this is what /me does.
-        self.loop.call_soon_threadsafe(self.do_msg, target_id, content)
+        self.send_msg(target_id, content)
 
     def message(self, target_id, content):
         target_id = self.config['channels'][target_id]
-        self.loop.call_soon_threadsafe(self.do_msg, target_id, content)
+        self.send_msg(target_id, content)
+
+    def send_msg(self, target_id, content):
+        if self.bridge.shared_loop:
+            self.do_msg(target_id, content)
+        else:
+            self.loop.call_soon_threadsafe(self.do_msg, target_id, content)
 
     def do_msg(self, target_id, content):
         channel = self.get_channel(target_id)
@@ -319,7 +400,7 @@ class DiscordBot(Client):
         except (discord.HTTPException, aiohttp.ClientError):
             logging.exception('Error sending "{}"'.format(content))
         except BaseException as e:
-            self.bridge.send_event(self, Target.Manager, 'exception', e)
+            self.bridge.send_event(self, Target.Manager, Name.exception, e)
 
     @staticmethod
     def is_action(message):
@@ -345,18 +426,28 @@ class DiscordBot(Client):
         del self.joined_channels[channel_id]
 
 class DiscordBridgeBot(DiscordBot):
+    def _present(self, member, discord_channel):
+        return (discord_channel.permissions_for(member).read_messages
+                    and member.status != Status.offline)
+
     def _sync_member(self, channel, member, discord_channel):
         if member != self.user:
-            if (discord_channel.permissions_for(member).read_messages
-                    and member.status != Status.offline):
+            if self._present(member, discord_channel):
                 self.bridge.discord_user_join(channel, member.id,
                                               member.display_name)
             else:
                 self.bridge.discord_user_leave(channel, member.id)
 
     def _sync_channel_members(self, channel, discord_channel):
+        joining = []
         for member in discord_channel.server.members:
-            self._sync_member(channel, member, discord_channel)
+            if member != self.user:
+                if self._present(member, discord_channel):
+                    joining.append((member.id, member.display_name))
+                else:
+                    self.bridge.discord_user_leave(channel, member.id)
+
+        self.bridge.discord_users_join(channel, joining)
 
     async def on_member_join(self, member):
         for channel_id, channel in self.joined_channels.items():
@@ -1,31 +1,68 @@
+import heapq
 import re
+import selectors
+import socket
 import threading
 import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from itertools import count
+from random import Random
+from time import monotonic
 
 from unidecode import unidecode
 
-from irc.bot import SingleServerIRCBot
+from irc.bot import SingleServerIRCBot, ExponentialBackoff as Reconnect
 from irc.buffer import LenientDecodingLineBuffer
-from irc.client import ServerConnection, ServerConnectionError
+from irc.client import Reactor, ServerConnection, ServerConnectionError
+from irc.client import ServerNotConnectedError
 from irc.strings import IRCFoldedCase
 from irc.dict import IRCDict
 
 from . import BaseBridge, User
+from ..backoff import ExponentialBackoff
+from ..cmdsys import command, commands, run_command
 from ..utf8wrap import Utf8Wrapper
-from ..event import Event, Target
+from ..event import Event, Name, Target
+from ..segments import MENTION, from_text, join, parse, render
+
+
+# A possible mention of an IRC nick, the nick may be followed by text
+_mention = re.compile(r'@([^ @]+)')
 
 
 class IRCBridge(BaseBridge):
     def __init__(self, config):
         BaseBridge.__init__(self, config)
+        self.reactor = SharedReactor()
         nick, name = config['nick'], config['name']
         self.bridge_bot = IRCBridgeBot(nick, name, self.config, self, id(self))
         self.user_bots = {}
         self.user_bots_lock = threading.Lock()
-        self.connect_queue = set()
-        self.connecting = set()
+        self.admission = ConnectScheduler(config.get('connect_limit', 3),
+                                          config.get('connect_limit_max', 30),
+                                          config.get('reconnect_window', 30))
+        self.admit_timer = None
+        self.admit_pending = False
+
+        # User bots are held back until the bridge bot is connected
+        self.admission.pause()
+
+        # In lazy mode user bots are only connected once their user
+        # speaks, and hibernated again when idle or over the cap.
+        self.lazy_bots = config.get('lazy_bots', False)
+        self.bot_idle_timeout = config.get('bot_idle_timeout')
+        self.max_user_bots = config.get('max_user_bots')
+        self.bot_activity = OrderedDict()
+        self.hibernate_timer = None
+
         self.users = {}
         self.user_map = IRCDict()
+        self.bot_nicks = IRCDict()
+        self.bot_nick_of = {}
+        self.nick_trie = NickTrie()
+        self._commands = commands(type(self), '_')
         self.thread = threading.Thread(target=self.run)
         self.terminated = False
 
@@ -34,7 +71,7 @@ class IRCBridge(BaseBridge):
         self.thread.start()
 
         for name in self.config['channels']:
-            self.send_event(self, Target.Manager, 'channel_join', name)
+            self.join_channel(name)
 
     def add_bot(self, user):
         nick = self.user_nick(user.name)
@@ -42,20 +79,80 @@ class IRCBridge(BaseBridge):
 
         with self.user_bots_lock:
             self.user_bots[user.id] = bot
-            self.connect_queue.add(user.id)
+            self.bot_activity[user.id] = monotonic()
+            self.admission.add(user.id)
+
+        self.admit_soon()
+        return bot
+
+    def remove_bot(self, user_id, message="I'll be back!"):
+        with self.user_bots_lock:
+            bot = self.user_bots.pop(user_id, None)
+            self.bot_activity.pop(user_id, None)
+            self.admission.discard(user_id)
+
+        if bot is not None:
+            self.reactor.call_soon(bot.disconnect, message)
+
+    def wake_bot(self, user_id):
+        """Create the bot of a user speaking for the first time"""
+        try:
+            user = self.get_user(user_id)
+        except KeyError:
+            return
+
+        bot = self.add_bot(user)
+        for channel in self.channels.values():
+            if user_id in channel._users:
+                bot.add_channel(channel)
+
+        self.user_spoke(user_id)
+        self.reactor.call_soon(self.hibernate_bots)
+
+    def hibernate_bots(self):
+        """Disconnect idle bots and bots over the cap, least active first"""
+        now = monotonic()
+        hibernating = []
+        next_active = None
+        with self.user_bots_lock:
+            count = len(self.bot_activity)
+            for user_id, active in self.bot_activity.items():
+                over = (self.max_user_bots is not None
+                            and count > self.max_user_bots)
+                idle = (self.bot_idle_timeout is not None
+                            and now - active >= self.bot_idle_timeout)
+                if not over and not idle:
+                    next_active = active
+                    break
+
+                hibernating.append(user_id)
+                count -= 1
+
+        for user_id in hibernating:
+            self.remove_bot(user_id, "Idle")
+
+        if self.hibernate_timer is not None:
+            self.reactor.cancel(self.hibernate_timer)
+            self.hibernate_timer = None
+
+        if self.bot_idle_timeout is not None and next_active is not None:
+            delay = next_active + self.bot_idle_timeout - now
+            self.hibernate_timer = self.reactor.call_later(
+                delay, self.hibernate_bots
+            )
 
     def user_add(self, channel, user):
         if user.id not in self.users:
-            if user.id not in self.user_bots:
-                self.add_bot(user)
-
-            self.user_bots[user.id].add_channel(channel)
+            if user.id in self.user_bots:
+                self.user_bots[user.id].add_channel(channel)
+            elif not self.lazy_bots:
+                self.add_bot(user).add_channel(channel)
 
     def on_channel_add(self, channel):
         self.bridge_bot.add_channel(channel)
 
         for user in channel.users:
-            self.user_add(self, channel, user)
+            self.user_add(channel, user)
 
     def on_channel_remove(self, channel):
         self.bridge_bot.remove_channel(channel)
@@ -76,37 +173,39 @@ class IRCBridge(BaseBridge):
             bot.remove_channel(channel)
 
             if not bot.joined_channels:
-                with self.user_bots_lock:
-                    del self.user_bots[user.id]
-                    self.connecting.discard(user.id)
-                    bot.disconnect()
-
-    def decode_mentions(self, content):
-        def replace(match):
-            user_id = int(match.group(1))
-            if user_id in self.users:
-                return '@{}'.format(self.users[user_id].nick)
-            elif user_id in self.user_bots:
-                nick = self.user_bots[user_id].connection.get_nickname()
-                return '@{}'.format(nick)
-            else:
-                return match.group()
+                self.remove_bot(user.id)
 
-        return re.sub(r'<\[@([0-9]+)\]>', replace, content)
+    def mention(self, user_id):
+        if user_id in self.users:
+            return '@{}'.format(self.users[user_id].nick)
+
+        # A bot only has a nick on IRC once it has been welcomed
+        bot = self.user_bots.get(user_id)
+        if bot is not None and bot.ready:
+            return '@{}'.format(bot.connection.get_nickname())
+
+        try:
+            return '@{}'.format(self.get_user(user_id).name)
+        except KeyError:
+            return None
 
-    def ev_message(self, event, content):
+    def decode_mentions(self, content, segments=None):
+        if segments is None:
+            segments = parse(content)
+
+        return render(segments, self.mention)
+
+    def ev_message(self, event, content, segments=None):
         if event.source_id in self.users:
             return
 
-        if event.source_id in self.user_bots:
-            bot = self.user_bots[event.source_id]
-        else:
+        content = self.decode_mentions(content, segments)
+        bot = self.speaking_bot(event.source_id)
+        if bot is None:
             name = self.name(event.source_id)
             content = '{} {}'.format(name, content)
             bot = self.bridge_bot
 
-        content = self.decode_mentions(content)
-
         if event.target_id in self.channels:
             bot.message(self.channels[event.target_id].name, content)
         elif event.target_id in self.users:
@@ -116,12 +215,14 @@ class IRCBridge(BaseBridge):
                 bot.message(channel.name, content)
 
 
-    def ev_action(self, event, content):
+    def ev_action(self, event, content, segments=None):
         if event.source_id in self.users:
             return
 
-        if event.source_id in self.user_bots:
-            method = self.user_bots[event.source_id].action
+        content = self.decode_mentions(content, segments)
+        bot = self.speaking_bot(event.source_id)
+        if bot is not None:
+            method = bot.action
         else:
             try:
                 name = self.get_user(event.source_id).name
@@ -131,8 +232,6 @@ class IRCBridge(BaseBridge):
             content = '* {} {}'.format(name, content)
             method = self.bridge_bot.message
 
-        content = self.decode_mentions(content)
-
         if event.target_id in self.channels:
             method(self.channels[event.target_id].name, content)
         elif event.target_id in self.users:
@@ -142,38 +241,146 @@ class IRCBridge(BaseBridge):
                 method(channel.name, content)
 
     def ev_shutdown(self, event):
+        self.reactor.call_soon(self.irc_shutdown)
+        self.detach()
+
+    def ev_command(self, event, command, authority):
+        run_command(self._commands, self, command,
+                    partial(self.send_event, self, event.source_id,
+                            Name.message))
+
+    def send_queues(self):
+        """Return a dict of nick to queued lines, seconds waited and drops"""
+        return {b._nickname: (b.send_queue.depth, b.send_queue.delay(),
+                              b.send_queue.dropped)
+                    for b in list(self.bots)
+                    if b.send_queue.depth or b.send_queue.dropped}
+
+    @command
+    def _queues(self):
+        queues = self.send_queues()
+        if not queues:
+            return "no lines are waiting to be sent"
+
+        return ', '.join('{}: {} ({:.1f}s)'.format(n, d, t) if not x else
+                         '{}: {} ({:.1f}s, {} dropped)'.format(n, d, t, x)
+                             for n, (d, t, x) in sorted(queues.items()))
+
+    @command
+    def _connecting(self):
+        return "connecting: {}, waiting: {}, limit: {:.1f}".format(
+            len(self.admission.connecting), self.admission.waiting(),
+            self.admission.limit
+        )
+
+    def reconnect_status(self):
+        """Return a dict of counters on how reconnecting bots are doing"""
+        status = self.admission.status()
+        status['bridge_ready'] = self.bridge_bot.ready
+        return status
+
+    @command
+    def _reconnects(self):
+        status = self.reconnect_status()
+        return ("bridge: {}, lost: {lost}, reconnected: {reconnected}, "
+                "to go: {to_go}, failed attempts: {failed}".format(
+                    'up' if status['bridge_ready'] else 'down', **status
+                ))
+
+    def irc_shutdown(self):
         for bot in self.bots:
             bot.disconnect("Bridge shutting down")
         self.terminated = True
-        self.detach()
 
     def on_terminate(self):
         self.terminated = True
+        self.reactor.wakeup()
 
     def run(self):
         try:
             while not self.terminated:
-                self.bridge_bot.reactor.process_once(0.2)
+                self.reactor.process_once(None)
+
+        except BaseException as e:
+            self.send_event(self, Target.Manager, Name.exception, e)
+
+    def speaking_bot(self, user_id):
+        """Returns the bot to speak through for a user, if it is ready
+
+        Messages from users whose bot is not connected yet are relayed
+        by the bridge bot instead.
+        """
+        bot = self.user_bots.get(user_id)
+        if bot is not None:
+            self.user_spoke(user_id)
+        elif self.lazy_bots:
+            self.wake_bot(user_id)
+
+        if bot is not None and bot.ready:
+            return bot
 
+    def user_spoke(self, user_id):
+        with self.user_bots_lock:
+            if user_id in self.bot_activity:
+                self.bot_activity[user_id] = monotonic()
+                self.bot_activity.move_to_end(user_id)
+
+        if self.admission.spoke(user_id):
+            self.admit_soon()
+
+    def admit_soon(self):
+        """Have admit run once from the reactor thread, however many ask"""
+        if not self.admit_pending:
+            self.admit_pending = True
+            self.reactor.call_soon(self.admit)
+
+    def admit(self):
+        """Start connecting the user bots the admission scheduler allows"""
+        self.admit_pending = False
+        while True:
+            admitted = self.admission.admit()
+            if not admitted:
+                break
+
+            for user_id in admitted:
                 with self.user_bots_lock:
-                    if len(self.connecting) < 3 and self.connect_queue:
-                        user_id = self.connect_queue.pop()
-                        try:
-                            self.user_bots[user_id].sane_connect()
-                        except ServerConnectionError:
-                            logging.error("Error connecting '{}'"
-                                          "".format(self.name(user_id)))
-                            self.connect_queue.add(user_id)
-                        except KeyError:
-                            pass # User bot has been removed
-                        else:
-                            self.connecting.add(user_id)
-
-                    for bot in self.user_bots.values():
-                        bot.reactor.process_once()
+                    bot = self.user_bots.get(user_id)
+
+                if bot is None:
+                    self.admission.discard(user_id)
+                    continue
+
+                try:
+                    bot.sane_connect()
+                except ServerConnectionError:
+                    logging.error("Error connecting '{}'"
+                                  "".format(self.name(user_id)))
+                    self.admission.failed(user_id)
+                else:
+                    attempt = self.admission.connecting.get(user_id)
+                    check = partial(self.connect_timeout, user_id, attempt)
+                    self.reactor.call_later(
+                        self.config.get('connect_timeout', 60), check
+                    )
+
+        if self.admit_timer is not None:
+            self.reactor.cancel(self.admit_timer)
+            self.admit_timer = None
+
+        delay = self.admission.next_delay()
+        if delay is not None:
+            self.admit_timer = self.reactor.call_later(delay, self.admit)
+
+    def connect_timeout(self, user_id, attempt):
+        if self.admission.connecting.get(user_id) != attempt:
+            return
 
-        except BaseException as e:
-            self.send_event(self, Target.Manager, 'exception', e)
+        logging.error("Timed out connecting '{}'".format(self.name(user_id)))
+        bot = self.user_bots.get(user_id)
+        if bot is not None and bot.connection.is_connected():
+            bot.connection.disconnect("Connection timed out")
+        else:
+            self.irc_connect_failed(user_id)
 
     def user_nick(self, name):
         name = unidecode(name)
@@ -197,35 +404,97 @@ class IRCBridge(BaseBridge):
         bot_iterators = ((self.bridge_bot,), self.user_bots.values())
         return (b for i in bot_iterators for b in i)
 
-    @property
-    def own_nicknames(self):
-        active_bots = (b for b in self.bots if b.connection.is_connected())
-        nicknames = map(lambda b: b.connection.get_nickname(), active_bots)
-        return map(IRCFoldedCase, nicknames)
-
     def irc_ready(self, user_id):
-        self.connecting.discard(user_id)
+        if user_id == id(self):
+            if self.admission.resume():
+                logging.info("Bridge bot connected, {} user bots waiting"
+                             "".format(self.admission.waiting()))
+                self.admit_soon()
+
+        elif self.admission.succeeded(user_id):
+            self.admit_soon()
+
+    def irc_connect_failed(self, user_id):
+        """Returns True if the bot will be retried by the scheduler"""
+        if self.admission.failed(user_id):
+            self.admit_soon()
+            return True
+
+        return False
+
+    def irc_bot_lost(self, user_id):
+        """Returns True if the bridge takes care of reconnecting the bot
+
+        User bots dropped by the server are brought back by the admission
+        scheduler, spread out over the reconnect window so that a server
+        restart does not have them all reconnecting at once.
+        """
+        if user_id == id(self):
+            logging.warning("Bridge bot lost its connection, holding back "
+                            "user bots until it is back")
+            self.admission.pause()
+            return False
+
+        if self.irc_connect_failed(user_id):
+            return True
+
+        with self.user_bots_lock:
+            if user_id in self.user_bots:
+                self.admission.lose(user_id)
+
+        self.admit_soon()
+        return True
+
+    def irc_bot_nick(self, user_id, nick):
+        self.irc_bot_gone(user_id)
+        self.bot_nicks[nick] = user_id
+        self.bot_nick_of[user_id] = nick
+        if user_id != id(self):
+            self.nick_trie.add(nick)
+
+    def irc_bot_gone(self, user_id):
+        nick = self.bot_nick_of.pop(user_id, None)
+        if nick is not None:
+            if self.bot_nicks.get(nick) == user_id:
+                del self.bot_nicks[nick]
+            if user_id != id(self):
+                self.nick_trie.discard(nick)
 
     def irc_user_join(self, channel, nick):
-        if nick in self.own_nicknames:
-            return
+        user_id = self.join_user(channel, nick)
+        if user_id is not None:
+            self.send_event(self, Target.Manager, Name.user_join,
+                            channel.id, user_id, nick)
+
+    def irc_users_join(self, channel, nicks):
+        users = []
+        for nick in nicks:
+            user_id = self.join_user(channel, nick)
+            if user_id is not None:
+                users.append((user_id, nick))
+
+        if users:
+            self.send_event(self, Target.Manager, Name.user_join_bulk,
+                            channel.id, tuple(users))
+
+    def join_user(self, channel, nick):
+        """Track nick in channel, returns its id if it was not there"""
+        if nick in self.bot_nicks:
+            return None
 
         if nick not in self.user_map:
             user = IRCUser(nick, {channel})
-            self.send_event(self, Target.Manager, 'user_join',
-                            channel.id, id(user), nick)
-
             self.users[id(user)] = user
             self.user_map[nick] = id(user)
+            self.nick_trie.add(nick)
+            return id(user)
 
-        else:
-            user = self.users[self.user_map[nick]]
-            if channel not in user.channels:
-                self.send_event(self, Target.Manager, 'user_join',
-                                channel.id, id(user), nick)
-
-                user.channels.add(channel)
+        user = self.users[self.user_map[nick]]
+        if channel not in user.channels:
+            user.channels.add(channel)
+            return id(user)
 
+        return None
 
     def irc_nick_change(self, old_nick, new_nick):
         if old_nick in self.user_map:
@@ -233,12 +502,14 @@ class IRCBridge(BaseBridge):
             user = self.users[user_id]
             for channel in self.channels.values():
                 if user in channel.users:
-                    self.send_event(self, Target.Manager, 'user_change',
+                    self.send_event(self, Target.Manager, Name.user_change,
                                     channel.id, user_id, new_nick)
 
             user._nick = new_nick
             del self.user_map[old_nick]
             self.user_map[new_nick] = user_id
+            self.nick_trie.discard(old_nick)
+            self.nick_trie.add(new_nick)
 
     def irc_user_leave(self, channel, nick):
         if nick in self.user_map:
@@ -248,7 +519,7 @@ class IRCBridge(BaseBridge):
             if channel not in user.channels:
                 return
 
-            self.send_event(self, Target.Manager, 'user_leave',
+            self.send_event(self, Target.Manager, Name.user_leave,
                             channel.id, user_id)
 
             user.channels.remove(channel)
@@ -256,48 +527,121 @@ class IRCBridge(BaseBridge):
             if not user.channels:
                 del self.users[user_id]
                 del self.user_map[nick]
+                self.nick_trie.discard(nick)
 
-    def nick_map(self):
-        nick_map = IRCDict({b.connection.get_nickname(): i
-                       for i, b in self.user_bots.items()
-                           if b.connection.is_connected()})
+    def nick_user_id(self, nick):
+        """Returns the user id for a nick on IRC, or None if unknown"""
+        if nick in self.user_map:
+            return self.user_map[nick]
 
-        nick_map.update(self.user_map)
-        return nick_map
+        user_id = self.bot_nicks.get(nick)
+        if user_id != id(self):
+            return user_id
 
     def convert_mentions(self, message):
-        nick_map = self.nick_map()
-
-        def replace(match):
+        """Returns the segments of a message with the mentions resolved"""
+        segments = []
+        pos = 0
+        for match in _mention.finditer(message):
             nick = match.group(1)
-            for i in range(len(nick), 0, -1):
-                part = nick[:i]
-                if part in nick_map:
-                    return '<[@{}]>{}'.format(nick_map[part], nick[i:])
-            else:
-                return match.group()
-
-        return re.sub(r'@([^ @]+)', replace, message)
+            length = self.nick_trie.longest_prefix(nick)
+            if length:
+                user_id = self.nick_user_id(nick[:length])
+                if user_id is not None:
+                    segments.extend(from_text(message[pos:match.start()]))
+                    segments.append((MENTION, user_id))
+                    pos = match.start(1) + length
+
+        segments.extend(from_text(message[pos:]))
+        return tuple(segments)
+
+    def send_message(self, source_id, target_id, name, message):
+        segments = self.convert_mentions(message)
+        self.send_event(source_id, target_id, name, join(segments),
+                        segments=segments)
 
     def irc_channel_message(self, channel, nick, message):
         if nick in self.user_map:
             user_id = self.user_map[nick]
-            message = self.convert_mentions(message)
-            self.send_event(user_id, channel.id, 'message', message)
+            self.send_message(user_id, channel.id, Name.message, message)
 
     def irc_channel_action(self, channel, nick, message):
         if nick in self.user_map:
             user_id = self.user_map[nick]
-            message = self.convert_mentions(message)
-            self.send_event(user_id, channel.id, 'action', message)
+            self.send_message(user_id, channel.id, Name.action, message)
 
     def irc_private_message(self, user_id, nick, message):
-        message = self.convert_mentions(message)
-        self.send_event(self.user_map[nick], user_id, 'message', message)
+        self.send_message(self.user_map[nick], user_id, Name.message, message)
 
     def irc_private_action(self, user_id, nick, message):
-        message = self.convert_mentions(message)
-        self.send_event(self.user_map[nick], user_id, 'action', message)
+        self.send_message(self.user_map[nick], user_id, Name.action, message)
+
+
+@lru_cache(maxsize=1024)
+def _fold(char):
+    return IRCFoldedCase(char).lower()
+
+class NickTrie:
+    """Case-folded prefix tree of IRC nicknames
+
+    Finds the longest known nick at the start of a string in a single
+    walk over it.  Nicks are reference counted, a nick that has been
+    added twice stays known until it has been discarded twice.
+    """
+
+    _end = None
+
+    def __init__(self):
+        self._root = {}
+        self._lock = threading.Lock()
+
+    def add(self, nick):
+        with self._lock:
+            node = self._root
+            for char in nick:
+                for folded in _fold(char):
+                    node = node.setdefault(folded, {})
+
+            node[self._end] = node.get(self._end, 0) + 1
+
+    def discard(self, nick):
+        with self._lock:
+            path = []
+            node = self._root
+            for char in nick:
+                for folded in _fold(char):
+                    if folded not in node:
+                        return
+                    path.append((node, folded))
+                    node = node[folded]
+
+            if self._end not in node:
+                return
+
+            node[self._end] -= 1
+            if node[self._end]:
+                return
+
+            # Prune the branches that no longer lead to any nick
+            del node[self._end]
+            while path and not node:
+                node, key = path.pop()
+                del node[key]
+
+    def longest_prefix(self, text):
+        """Returns the length of the longest known nick text starts with"""
+        node = self._root
+        longest = 0
+        for index, char in enumerate(text, 1):
+            for folded in _fold(char):
+                node = node.get(folded)
+                if node is None:
+                    return longest
+
+            if self._end in node:
+                longest = index
+
+        return longest
 
 
 class IRCUser:
@@ -326,21 +670,540 @@ class IRCUser:
 # Prevent decoding errors from IRC clients that don't use UTF-8
 ServerConnection.buffer_class = LenientDecodingLineBuffer
 
+class BufferedConnection(ServerConnection):
+    """Server connection that never blocks the reactor thread on writes
+
+    The socket is non-blocking, what it does not accept right away is
+    kept in a write buffer and sent once the shared reactor finds the
+    socket writable again.
+    """
+
+    def connect(self, *args, **kwargs):
+        self.write_buffer = bytearray()
+        return ServerConnection.connect(self, *args, **kwargs)
+
+    def send_raw(self, string):
+        if self.socket is None:
+            raise ServerNotConnectedError("Not connected.")
+        self.write(self._prep_message(string))
+
+    def write(self, data):
+        """Send data, buffering what the socket does not take now"""
+        waiting = bool(self.write_buffer)
+        self.write_buffer += data
+        if not waiting:
+            self.send_buffer()
+
+    def send_buffer(self):
+        """Send as much of the write buffer as the socket accepts"""
+        try:
+            sent = self.socket.send(self.write_buffer)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect("Connection reset by peer.")
+            return
+
+        del self.write_buffer[:sent]
+        self.reactor.shared.want_write(self.socket, self.reactor,
+                                       bool(self.write_buffer))
+
+class SendQueue:
+    """Outgoing lines of a connection paced by a token bucket
+
+    Lines are queued per target, and targets take turns sending a line
+    so that a long paste to one channel does not hold up the others.
+    Up to burst lines are let through at once, after which they are let
+    through at rate lines per second.  No more than limit lines are held,
+    past that the newest line of the longest queue is dropped, cutting
+    short the paste that is flooding the connection.
+    """
+
+    def __init__(self, burst, rate, limit=None):
+        self.burst = burst
+        self.rate = rate
+        self.limit = limit
+        self.depth = 0
+        self.dropped = 0
+        self.pending = False
+        self._tokens = burst
+        self._updated = monotonic()
+        self._queues = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, target, line):
+        """Queue a line, returns True if the queue needs to be flushed"""
+        with self._lock:
+            queue = self._queues.setdefault(target, deque())
+            queue.append((monotonic(), line))
+            self.depth += 1
+
+            if self.limit is not None and self.depth > self.limit:
+                longest = max(self._queues,
+                              key=lambda t: len(self._queues[t]))
+                self._queues[longest].pop()
+                if not self._queues[longest]:
+                    del self._queues[longest]
+                self.depth -= 1
+                self.dropped += 1
+
+            flush, self.pending = not self.pending, True
+            return flush
+
+    def take(self):
+        """Take the lines that may be sent now
+
+        Returns a list of lines and the delay in seconds until the next
+        line may be sent, or None if the queue is now empty.
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens
+                                   + (now - self._updated) * self.rate)
+            self._updated = now
+
+            lines = []
+            while self._queues and self._tokens >= 1:
+                target, queue = next(iter(self._queues.items()))
+                lines.append(queue.popleft()[1])
+                self._tokens -= 1
+
+                if queue:
+                    self._queues.move_to_end(target)
+                else:
+                    del self._queues[target]
+
+            self.depth -= len(lines)
+            if self._queues:
+                return lines, (1 - self._tokens) / self.rate
+
+            self.pending = False
+            return lines, None
+
+    def delay(self):
+        """Returns how long the oldest queued line has been waiting"""
+        with self._lock:
+            if not self._queues:
+                return 0
+
+            oldest = min(q[0][0] for q in self._queues.values())
+            return monotonic() - oldest
+
+class ConnectScheduler:
+    """Decides when user bots may start connecting
+
+    Connection attempts are admitted up to a concurrency limit.  The
+    limit grows by one for every limit bots that connect successfully,
+    and is halved whenever an attempt fails from throttling, K-lines,
+    timeouts and the like.  Failed bots are retried after a backoff of
+    their own, and hold on to their slot until then so that a server
+    refusing connections is not tried again at once by the next bot.
+    Users who have just spoken are admitted first.  Bots that lose
+    their connection are brought back at a random point in the reconnect
+    window, and nothing is admitted while paused.
+
+    Parameters
+    ----------
+    limit : int
+        Connection attempts allowed at once to begin with.
+    max_limit : int
+        Most connection attempts the limit may grow to.
+    window : float
+        Seconds to spread the reconnects of lost bots over.
+    """
+
+    def __init__(self, limit=3, max_limit=30, window=30):
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.window = window
+        self.paused = False
+        self.connecting = {}
+        self._ready = OrderedDict()
+        self._urgent = OrderedDict()
+        self._spoke = set()
+        self._delayed = {}
+        self._delay_heap = []
+        self._backoffs = {}
+        self._lost = set()
+        self._cooling = set()
+        self._counts = {'lost': 0, 'reconnected': 0, 'failed': 0}
+        self._random = Random()
+        self._lock = threading.Lock()
+
+    def add(self, user_id):
+        """Queue a bot to be connected"""
+        with self._lock:
+            self._ready[user_id] = None
+
+    def discard(self, user_id):
+        """Forget about a bot that has been removed"""
+        with self._lock:
+            self._ready.pop(user_id, None)
+            self._urgent.pop(user_id, None)
+            self._delayed.pop(user_id, None)
+            self._spoke.discard(user_id)
+            self._backoffs.pop(user_id, None)
+            self._lost.discard(user_id)
+            self._cooling.discard(user_id)
+            self.connecting.pop(user_id, None)
+
+    def lose(self, user_id):
+        """Queue a bot that lost its connection to be connected again"""
+        with self._lock:
+            self._lost.add(user_id)
+            self._counts['lost'] += 1
+            self._delay(user_id, monotonic()
+                                     + self._random.uniform(0, self.window))
+
+    def pause(self):
+        """Stop admitting bots until resumed"""
+        with self._lock:
+            self.paused = True
+
+    def resume(self):
+        """Admit bots again, returns True if the scheduler was paused
+
+        Bots whose delay ran out while paused are spread over the window
+        again, rather than all being admitted the moment it resumes.
+        """
+        with self._lock:
+            if not self.paused:
+                return False
+
+            self.paused = False
+            now = monotonic()
+            for user_id, when in list(self._delayed.items()):
+                if when <= now:
+                    self._delay(user_id, now
+                                    + self._random.uniform(0, self.window))
+            return True
+
+    def spoke(self, user_id):
+        """Move a waiting bot ahead, returns True if it is ready for it"""
+        with self._lock:
+            if user_id in self._ready:
+                del self._ready[user_id]
+                self._urgent[user_id] = None
+                return True
+
+            if user_id in self._delayed:
+                self._spoke.add(user_id)
+
+            return False
+
+    def admit(self):
+        """Returns the bots that may start connecting now"""
+        with self._lock:
+            if self.paused:
+                return []
+
+            now = monotonic()
+            while self._delay_heap and self._delay_heap[0][0] <= now:
+                when, user_id = heapq.heappop(self._delay_heap)
+                if self._delayed.get(user_id) == when:
+                    del self._delayed[user_id]
+                    self._cooling.discard(user_id)
+                    if user_id in self._spoke:
+                        self._spoke.remove(user_id)
+                        self._urgent[user_id] = None
+                    else:
+                        self._ready[user_id] = None
+
+            admitted = []
+            busy = len(self.connecting) + len(self._cooling)
+            while busy < int(self.limit) and (self._urgent or self._ready):
+                user_id, _ = (self._urgent or self._ready).popitem(False)
+                self.connecting[user_id] = now
+                admitted.append(user_id)
+                busy += 1
+
+            return admitted
+
+    def next_delay(self):
+        """Seconds until a bot waiting on its backoff is ready, or None"""
+        with self._lock:
+            if self.paused:
+                return None
+
+            while self._delay_heap:
+                when, user_id = self._delay_heap[0]
+                if self._delayed.get(user_id) == when:
+                    return max(0, when - monotonic())
+                heapq.heappop(self._delay_heap)
+
+    def succeeded(self, user_id):
+        """Record a bot as connected, returns True if it was connecting"""
+        with self._lock:
+            if self.connecting.pop(user_id, None) is None:
+                return False
+
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._backoffs.pop(user_id, None)
+            if user_id in self._lost:
+                self._lost.remove(user_id)
+                self._counts['reconnected'] += 1
+            return True
+
+    def failed(self, user_id):
+        """Record a failed attempt, returns True if it was connecting"""
+        with self._lock:
+            if self.connecting.pop(user_id, None) is None:
+                return False
+
+            self.limit = max(1.0, self.limit / 2)
+            self._counts['failed'] += 1
+            backoff = self._backoffs.setdefault(user_id, ExponentialBackoff())
+            self._delay(user_id, monotonic() + backoff.delay())
+            self._cooling.add(user_id)
+            return True
+
+    def _delay(self, user_id, when):
+        self._delayed[user_id] = when
+        heapq.heappush(self._delay_heap, (when, user_id))
+
+    def waiting(self):
+        """Returns the number of bots waiting to connect"""
+        with self._lock:
+            return len(self._ready) + len(self._urgent) + len(self._delayed)
+
+    def status(self):
+        """Returns a dict of the reconnect counters and current state"""
+        with self._lock:
+            status = dict(self._counts)
+            status['to_go'] = len(self._lost)
+            status['connecting'] = len(self.connecting)
+            status['limit'] = self.limit
+            return status
+
+class SharedReactor:
+    """Polls the connections of many IRC bots with one selector
+
+    Every bot keeps a BotReactor of its own for its handlers, while the
+    sockets, scheduler and mutex are shared so that a single thread can
+    wait on all of them at once.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.scheduler = Reactor.scheduler_class()
+        self.mutex = threading.RLock()
+
+        # Other threads hand work to the reactor thread through calls,
+        # writing to the wakeup socket to interrupt a waiting select.
+        self._calls = deque()
+        self._calls_lock = threading.Lock()
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._wake_send.setblocking(False)
+        self.selector.register(self._wake_recv, selectors.EVENT_READ, None)
+
+        # Timers set by the reactor thread, as [deadline, seq, func]
+        self._timers = []
+        self._timer_seq = count()
+
+    def call_later(self, delay, func):
+        """Have func called after delay seconds, from the reactor thread
+
+        Returns a timer that can be passed to cancel.
+        """
+        timer = [monotonic() + delay, next(self._timer_seq), func]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer returned by call_later"""
+        timer[2] = None
+
+    def call_soon(self, func, *args):
+        """Have func called with args from the reactor thread"""
+        with self._calls_lock:
+            wake = not self._calls
+            self._calls.append((func, args))
+
+        if wake:
+            self.wakeup()
+
+    def wakeup(self):
+        """Interrupt the reactor thread if it is waiting"""
+        try:
+            self._wake_send.send(b'\0')
+        except BlockingIOError:
+            pass # The reactor has plenty of wakeups pending already
+
+    def register(self, sock, reactor):
+        with self.mutex:
+            # A socket closed without being unregistered may have left a
+            # stale key behind for the same file descriptor.
+            if sock in self.selector.get_map():
+                self.selector.unregister(sock)
+            self.selector.register(sock, selectors.EVENT_READ, reactor)
+
+    def want_write(self, sock, reactor, writing):
+        """Set whether the reactor is told when sock is writable"""
+        events = selectors.EVENT_READ
+        if writing:
+            events |= selectors.EVENT_WRITE
+
+        with self.mutex:
+            try:
+                if self.selector.get_key(sock).events != events:
+                    self.selector.modify(sock, events, reactor)
+            except (KeyError, ValueError):
+                pass
+
+    def unregister(self, sock):
+        with self.mutex:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def process_once(self, timeout=0):
+        """Wait up to timeout for data and process it
+
+        A timeout of None waits until there is data, a call or a timer
+        is due.
+        """
+        deadlines = [] if timeout is None else [timeout]
+        if self._timers:
+            deadlines.append(self._timers[0][0] - monotonic())
+        if self.scheduler.queue:
+            due = self.scheduler.queue[0] - datetime.now(timezone.utc)
+            deadlines.append(due.total_seconds())
+        if deadlines:
+            timeout = max(0, min(deadlines))
+
+        ready = self.selector.select(timeout)
+        with self.mutex:
+            for key, mask in ready:
+                if key.data is None:
+                    self._drain_wakeups()
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    key.data.process_write()
+                if mask & selectors.EVENT_READ:
+                    key.data.process_data([key.fileobj])
+
+            self.run_calls()
+            self._run_timers()
+            self.scheduler.run_pending()
+
+    def _run_timers(self):
+        now = monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, func = heapq.heappop(self._timers)
+            if func is not None:
+                func()
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run_calls(self):
+        """Run the calls handed over by other threads"""
+        with self._calls_lock:
+            calls, self._calls = self._calls, deque()
+
+        for func, args in calls:
+            func(*args)
+
+class BotReactor(Reactor):
+    """Handlers and connection of a single bot on a SharedReactor"""
+
+    def __init__(self, shared):
+        Reactor.__init__(self, on_connect=self._on_socket_connect)
+        self.shared = shared
+        self.scheduler = shared.scheduler
+        self.mutex = shared.mutex
+        self._socket = None
+
+    def server(self):
+        connection = BufferedConnection(self)
+        with self.mutex:
+            self.connections.append(connection)
+        return connection
+
+    def _on_socket_connect(self, sock):
+        sock.setblocking(False)
+        self._socket = sock
+        self.shared.register(sock, self)
+
+    def process_write(self):
+        """Called when the socket can take more of the write buffer"""
+        with self.mutex:
+            for connection in self.connections:
+                if connection.socket is self._socket:
+                    connection.send_buffer()
+
+    def _handle_event(self, connection, event):
+        if event.type == 'disconnect' and self._socket is not None:
+            self.shared.unregister(self._socket)
+            self._socket = None
+
+        Reactor._handle_event(self, connection, event)
+
+@lru_cache(maxsize=256)
+def _wrap_lines(content, width):
+    # Messages to all channels, and the same content relayed by several
+    # bots, are wrapped once and the lines reused for each target.
+    wrapper = Utf8Wrapper(width=width)
+    lines = content.replace('\r', '\n').split('\n')
+
+    # NOTE: Lines containing just spaces are stripped out by the
+    #       text wrapper.
+
+    return tuple(part for line in lines for part in wrapper.wrap(line))
+
 class IRCBot(SingleServerIRCBot):
     def __init__(self, nick, name, config, bridge, user_id):
-        SingleServerIRCBot.__init__(self, [config['server']], nick, name)
+        self.reactor_class = partial(BotReactor, bridge.reactor)
+
+        # The default reconnect strategy is a single instance shared by
+        # every bot, each bot needs one of its own.
+        recon = Reconnect(min_interval=config.get('reconnect_interval', 60))
+        SingleServerIRCBot.__init__(self, [config['server']], nick, name,
+                                    recon=recon)
 
         self.config = config
         self.bridge = bridge
         self.user_id = user_id
         self.joined_channels = IRCDict()
         self.distinguisher = 1
+        self.closing = False
+        self.ready = False
+        self.send_queue = SendQueue(config.get('flood_burst', 5),
+                                    config.get('flood_rate', 0.5),
+                                    config.get('flood_limit', 100))
 
         self.wrapper = Utf8Wrapper(width=400)
 
     def die(self):
         raise RuntimeError("This function would have called sys.exit()")
 
+    def disconnect(self, msg="I'll be back!"):
+        # The reconnect scheduler is shared with the other bots and keeps
+        # running, it must not bring back a bot that was removed.
+        self.closing = True
+        SingleServerIRCBot.disconnect(self, msg)
+
+    def _on_disconnect(self, connection, event):
+        # User bots are reconnected by the bridge's connection scheduler
+        if self.closing or self.bridge.irc_bot_lost(self.user_id):
+            self.channels = IRCDict()
+        else:
+            SingleServerIRCBot._on_disconnect(self, connection, event)
+
+    def on_error(self, connection, event):
+        logging.error("{}: {}".format(self._nickname, event.target))
+
+    def on_yourebannedcreep(self, connection, event):
+        logging.error("{} is banned: {}"
+                      "".format(self._nickname, ' '.join(event.arguments)))
+
     def sane_connect(self):
         server = self.server_list[0]
         self.connect(server.host, server.port, self._nickname,
@@ -348,14 +1211,33 @@ class IRCBot(SingleServerIRCBot):
                      **self._SingleServerIRCBot__connect_params)
 
     def _part(self, content):
-        lines = content.replace('\r', '\n').split('\n')
-
-        # NOTE: Lines containing just spaces are stripped out by the
-        #       text wrapper.
-
-        for line in lines:
-            for part in self.wrapper.wrap(line):
-                yield part
+        return _wrap_lines(content, self.wrapper.width)
+
+    def send_later(self, target, line):
+        """Queue a line to be sent from the reactor thread
+
+        Bot methods called by the bridge from the manager's thread go
+        through here instead of writing to the connection directly.
+        Lines are paced by the send queue and flushed in batches.
+        """
+        if self.send_queue.put(target, line):
+            self.reactor.shared.call_soon(self.flush)
+
+    def flush(self):
+        lines, delay = self.send_queue.take()
+        if lines and self.connection.is_connected():
+            data = bytearray()
+            for line in lines:
+                try:
+                    data += self.connection._prep_message(line)
+                except ValueError:
+                    logging.exception("Dropping line for {}"
+                                      "".format(self._nickname))
+            if data:
+                self.connection.write(data)
+
+        if delay is not None:
+            self.reactor.shared.call_later(delay, self.flush)
 
     def message(self, target, content):
         if target in self.config['channels']:
@@ -363,7 +1245,8 @@ class IRCBot(SingleServerIRCBot):
 
         if self.connection.is_connected():
             for part in self._part(content):
-                self.connection.privmsg(target, part)
+                line = 'PRIVMSG {} :{}'.format(target, part)
+                self.send_later(target, line)
         else:
             print("Dropping message for", self._nickname)
 
@@ -373,7 +1256,8 @@ class IRCBot(SingleServerIRCBot):
 
         if self.connection.is_connected():
             for part in self._part(content):
-                self.connection.action(target, part)
+                line = 'PRIVMSG {} :\x01ACTION {}\x01'.format(target, part)
+                self.send_later(target, line)
         else:
             print("Dropping action for", self._nickname)
 
@@ -392,10 +1276,20 @@ class IRCBot(SingleServerIRCBot):
         print('Error:', event.target, event.arguments[0])
 
     def on_welcome(self, connection, event):
+        self.ready = True
+        self.bridge.irc_bot_nick(self.user_id, connection.get_nickname())
         self.bridge.irc_ready(self.user_id)
         for irc_channel in self.joined_channels:
             connection.join(irc_channel)
 
+    def on_nick(self, connection, event):
+        if event.target == connection.get_nickname():
+            self.bridge.irc_bot_nick(self.user_id, event.target)
+
+    def on_disconnect(self, connection, event):
+        self.ready = False
+        self.bridge.irc_bot_gone(self.user_id)
+
     def on_privmsg(self, connection, event):
         self.bridge.irc_private_message(self.user_id, event.source.nick,
                                         event.arguments[0])
@@ -409,23 +1303,61 @@ class IRCBot(SingleServerIRCBot):
         self._nickname, self.distinguisher = nick, 1
 
         if self.connection.is_connected():
-            self.connection.nick(nick)
+            self.send_later(None, 'NICK {}'.format(nick))
 
     def add_channel(self, channel):
         irc_channel = self.config['channels'][channel.name]
         self.joined_channels[irc_channel] = channel
 
         if self.connection.is_connected():
-            self.connection.join(irc_channel)
+            self.send_later(irc_channel, 'JOIN {}'.format(irc_channel))
 
     def remove_channel(self, channel):
         irc_channel = self.config['channels'][channel.name]
         if self.connection.is_connected():
-            self.connection.part(irc_channel)
+            self.send_later(irc_channel, 'PART {}'.format(irc_channel))
 
         del self.joined_channels[irc_channel]
 
 class IRCBridgeBot(IRCBot):
+    health_timer = None
+
+    def __init__(self, *args):
+        IRCBot.__init__(self, *args)
+        self.names = IRCDict()
+
+    def on_welcome(self, connection, event):
+        IRCBot.on_welcome(self, connection, event)
+        self.last_pong = monotonic()
+        self.check_health()
+
+    def on_disconnect(self, connection, event):
+        IRCBot.on_disconnect(self, connection, event)
+        if self.health_timer is not None:
+            self.reactor.shared.cancel(self.health_timer)
+            self.health_timer = None
+
+    def check_health(self):
+        """Ping the server and drop the connection if it stopped replying
+
+        A connection that silently died in a netsplit would otherwise be
+        taken as healthy, and keep letting user bots through.
+        """
+        interval = self.config.get('health_interval', 60)
+        if monotonic() - self.last_pong > 2 * interval:
+            logging.error("Bridge bot ping timeout")
+            self.health_timer = None
+            self.connection.disconnect("Ping timeout")
+            return
+
+        # Armed first, a failing ping disconnects and cancels it right away
+        self.health_timer = self.reactor.shared.call_later(interval,
+                                                           self.check_health)
+        self.connection.ping(self.connection.server)
+
+    def on_pong(self, connection, event):
+        self.last_pong = monotonic()
+
     def on_pubmsg(self, connection, event):
         channel, nick = self.joined_channels[event.target], event.source.nick
         self.bridge.irc_channel_message(channel, nick, event.arguments[0])
@@ -438,18 +1370,27 @@ class IRCBridgeBot(IRCBot):
             self.bridge.irc_channel_action(channel, nick, event.arguments[0])
 
     def on_nick(self, connection, event):
+        IRCBot.on_nick(self, connection, event)
+
         before = event.source.nick
         after = event.target
 
         self.bridge.irc_nick_change(before, after)
 
     def on_namreply(self, connection, event):
-        channel = self.joined_channels[event.arguments[1]]
-        users = event.arguments[2].strip(' ').split(' ')
-        for nick in users:
+        # The reply to NAMES is spread over many lines, the nicks are
+        # collected and joined in one go once it ends.
+        names = self.names.setdefault(event.arguments[1], [])
+        for nick in event.arguments[2].strip(' ').split(' '):
             if nick[0] in '~@&+':
                 nick = nick[1:]
-            self.bridge.irc_user_join(channel, nick)
+            names.append(nick)
+
+    def on_endofnames(self, connection, event):
+        nicks = self.names.pop(event.arguments[0], [])
+        if event.arguments[0] in self.joined_channels:
+            channel = self.joined_channels[event.arguments[0]]
+            self.bridge.irc_users_join(channel, nicks)
 
     def on_join(self, connection, event):
         channel = self.joined_channels[event.target]
@@ -0,0 +1,298 @@
+import logging
+import marshal
+import multiprocessing
+import queue
+import threading
+
+from . import BaseBridge
+from ..event import Event, Name, Target
+from ..segments import MENTION, join, parse
+
+
+# Object ids only mean something inside the process they came from, so
+# ids are sent over the link as codes.  Code 0 stands for the bridge at
+# either end of the link and the codes up to _RESERVED for the targets.
+# Ids from the sending process are sent offset past those, and ids that
+# the receiving process sent earlier are sent back negated.  Each end
+# stands in for the ids of the other end with ids of token objects of
+# its own, which no other live object there can have.
+_SELF = 0
+_targets = (Target.Everything, Target.Manager, Target.AllBridges,
+            Target.AllChannels, Target.AllUsers)
+_target_codes = {id(t): c for c, t in enumerate(_targets, 1)}
+_code_targets = {c: id(t) for c, t in enumerate(_targets, 1)}
+_RESERVED = len(_targets) + 1
+
+# Arguments of events that hold ids, by position: 'i' is an id, 's' a
+# sequence of ids and 'u' a sequence of (id, name) pairs.
+_id_args = {
+    Name.channel_add: 'i-u',
+    Name.channel_remove: 'i',
+    Name.user_add: 'i',
+    Name.user_update: 'i',
+    Name.user_remove: 'i',
+    Name.user_add_bulk: 'u',
+    Name.user_remove_bulk: 's',
+    Name.user_join: 'ii',
+    Name.user_change: 'ii',
+    Name.user_leave: 'ii',
+    Name.user_join_bulk: 'iu',
+    Name.user_leave_bulk: 'is',
+}
+
+
+class RemoteBridgeError(Exception):
+    """Exception propagated from a bridge in another process"""
+
+
+class _LinkIds:
+    """Translates ids to and from the codes sent over a link"""
+
+    def __init__(self, self_id):
+        self.self_id = self_id
+        self._tokens = {}
+        self._codes = {}
+
+    def encode(self, item_id):
+        if item_id == self.self_id:
+            return _SELF
+        if item_id in _target_codes:
+            return _target_codes[item_id]
+        if item_id in self._codes:
+            return -self._codes[item_id]
+        return item_id + _RESERVED
+
+    def decode(self, code):
+        if code == _SELF:
+            return self.self_id
+        if code < 0:
+            return -code - _RESERVED
+        if code < _RESERVED:
+            return _code_targets[code]
+
+        # The token is kept for as long as the link, the id it stands
+        # for may be reused by the other end but never for two live
+        # objects at once.
+        token = self._tokens.get(code)
+        if token is None:
+            token = self._tokens[code] = object()
+            self._codes[id(token)] = code
+        return id(token)
+
+def _convert(name, args, kwargs, convert):
+    # Returns args and kwargs of an event with the ids in them converted
+    args = list(args)
+    for i, kind in enumerate(_id_args.get(name, '')):
+        if kind == 'i':
+            args[i] = convert(args[i])
+        elif kind == 's':
+            args[i] = tuple(map(convert, args[i]))
+        elif kind == 'u':
+            args[i] = tuple((convert(u), n) for u, n in args[i])
+
+    # Mentions are carried in the segments, and the content is rebuilt
+    # from them with the converted ids in its markers.
+    if name in (Name.message, Name.action):
+        segments = kwargs.get('segments')
+        if segments is None:
+            segments = parse(args[0])
+        segments = tuple((k, convert(v)) if k == MENTION else (k, v)
+                             for k, v in segments)
+        args[0] = join(segments)
+        kwargs = dict(kwargs, segments=segments)
+
+    return tuple(args), dict(kwargs)
+
+def encode(event, ids):
+    """Serialize an event into a compact binary frame
+
+    Events are encoded with marshal, which handles the plain data
+    types carried in event arguments.  Exceptions are sent as their
+    repr and raised as RemoteBridgeError on the other side.  The ids in
+    the event are encoded with ids, a _LinkIds for this end.
+    """
+    args, kwargs = _convert(event.name, event.args, event.kwargs,
+                            ids.encode)
+    if event.name == Name.exception:
+        args = tuple(repr(a) for a in args)
+
+    return marshal.dumps((ids.encode(event.source_id),
+                          ids.encode(event.target_id),
+                          event.name, args, kwargs))
+
+def decode(data, ids):
+    """Deserialize a frame created by encode into an Event"""
+    return _event(marshal.loads(data), ids)
+
+def _event(frame, ids):
+    source_id, target_id, name, args, kwargs = frame
+    if name == Name.exception:
+        args = tuple(RemoteBridgeError(a) for a in args)
+
+    args, kwargs = _convert(name, args, kwargs, ids.decode)
+    return Event(ids.decode(source_id), ids.decode(target_id), name,
+                 *args, **kwargs)
+
+
+class _Names:
+    def __init__(self):
+        self._names = {}
+
+    def name_of(self, item_id, default=None):
+        return self._names.get(item_id, default)
+
+
+class _RemoteManager:
+    """Stand-in for the BridgeManager inside a bridge hosting process"""
+
+    def __init__(self, conn, bridge):
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._ids = _LinkIds(id(bridge))
+        self.events = self
+        self.bridges = _Names()
+        self.channels = _Names()
+
+    def put(self, event):
+        data = encode(event, self._ids)
+        with self._lock:
+            self._conn.send_bytes(data)
+
+    def recv(self):
+        while True:
+            frame = marshal.loads(self._conn.recv_bytes())
+            if len(frame) == 5:
+                return _event(frame, self._ids)
+
+            # Name of a bridge or channel on the manager side
+            kind, code, name = frame
+            getattr(self, kind)._names[self._ids.decode(code)] = name
+
+
+def host(bridge_class, config, conn):
+    """Run a bridge in this process, connected to a RemoteBridge"""
+    bridge = bridge_class(config)
+    manager = _RemoteManager(conn, bridge)
+    bridge.register(manager)
+
+    try:
+        while bridge.is_registered:
+            try:
+                event = manager.recv()
+            except EOFError:
+                bridge.terminate()
+                break
+
+            bridge._dispatch(event)
+    finally:
+        conn.close()
+
+
+class RemoteBridge(BaseBridge):
+    """Proxy for a bridge hosted in a separate process
+
+    The bridge given by bridge_class is created with config in a child
+    process, and events are passed between it and this proxy over a
+    pipe.  From the manager's point of view the proxy is the bridge.
+    Both bridge_class and config must be picklable.  Events are written
+    to the pipe by a thread of the proxy, so that a busy child does not
+    hold up the manager.
+    """
+
+    # Dispatching only encodes and queues the event for the sender
+    channel_safe = True
+
+    def __init__(self, config, bridge_class):
+        BaseBridge.__init__(self, config)
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self._child_conn = child_conn
+        self._ids = _LinkIds(id(self))
+        self._named = {}
+        self._outbox = queue.Queue()
+        self.process = context.Process(target=host, daemon=True,
+                                       args=(bridge_class, config, child_conn))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.sender = threading.Thread(target=self.send_loop, daemon=True)
+        self.closing = False
+
+    @property
+    def depth(self):
+        return self._outbox.qsize()
+
+    def on_register(self):
+        self._events = self._manager.events
+        self.process.start()
+        self._child_conn.close()
+        self.thread.start()
+        self.sender.start()
+
+    def on_deregister(self):
+        self.close()
+
+    def on_terminate(self):
+        self.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def close(self):
+        # The pipe is closed once what was queued for the child is sent
+        self.closing = True
+        self._outbox.put(None)
+
+    def _send_names(self, item_id):
+        # Names are sent again when they change, ids of dropped channels
+        # and bridges are reused for new ones.
+        for kind in ('bridges', 'channels'):
+            name = getattr(self._manager, kind).name_of(item_id, None)
+            if name is not None:
+                if self._named.get(item_id) != (kind, name):
+                    self._named[item_id] = (kind, name)
+                    frame = (kind, self._ids.encode(item_id), name)
+                    self._outbox.put(marshal.dumps(frame))
+                break
+
+    def _dispatch(self, event):
+        # All bridge state lives in the hosting process, so everything
+        # is forwarded there instead of being handled by the proxy.
+        if self.closing:
+            return
+
+        if self.is_registered:
+            self._send_names(event.source_id)
+            self._send_names(event.target_id)
+
+        self._outbox.put(encode(event, self._ids))
+
+    def send_loop(self):
+        try:
+            while True:
+                data = self._outbox.get()
+                if data is None:
+                    break
+
+                self._conn.send_bytes(data)
+
+        except OSError:
+            # Losing the child is reported by run
+            self.closing = True
+
+        finally:
+            self._conn.close()
+
+    def run(self):
+        try:
+            while True:
+                event = decode(self._conn.recv_bytes(), self._ids)
+                if event.name == Name.detach and event.source_id == id(self):
+                    self.closing = True
+
+                self._events.put(event)
+
+        except (EOFError, OSError):
+            if not self.closing:
+                logging.error("Lost connection to bridge process")
+                error = RemoteBridgeError("bridge process exited")
+                self._events.put(Event(self, Target.Manager,
+                                       Name.exception, error))
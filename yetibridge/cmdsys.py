@@ -1,94 +1,173 @@
-from inspect import getattr_static, signature
+import re
+from functools import lru_cache
+from inspect import getattr_static, ismethod, signature
 
 
-class _Literal:
-    def __init__(self, characters):
-        self.characters = ''
-        for char in characters:
-            if isinstance(char, _Literal):
-                self.characters += char.characters
-            else:
-                self.characters += char
+_token = re.compile(r'''
+      (?P<blank>[ \t]+)
+    | \\(?P<escaped>.)
+    | "(?P<quoted>(?:\\.|[^"\\])*)"
+    | (?P<unmatched>")
+    | (?P<plain>[^ \t\\"]+|\\)
+''', re.VERBOSE | re.DOTALL)
+
+_escape = re.compile(r'\\(.)', re.DOTALL)
 
 def split(string):
     """Parse a string into an argument list
 
-    Splits a string of optionally quoted arguments into a list of words
-    using a 3 stage process.  Escapes are done with a '\' character and
-    it's effect is to turn the next character into a literal with no
-    special meaning.  Quotes are then stripped out, and the content
-    inside them is preserved, finally whitespace sepparates words.  Note
-    that quoted text adjacant non-whitespace or escaped literal is not
-    split up into separate words.
+    Splits a string of optionally quoted arguments into a list of words.
+    Escapes are done with a '\' character and it's effect is to turn the
+    next character into a literal with no special meaning.  Quotes are
+    stripped out, and the content inside them is preserved, finally
+    whitespace sepparates words.  Note that quoted text adjacant
+    non-whitespace or escaped literal is not split up into separate
+    words.
 
     Example: The string 'Augment\ this  "string"_\"battle\" ' is parsed
              into the list ['Augment this', 'string_"battle"'].
 
     """
 
-    # Turn into a list of characters
-    array = list(map(str, string))
+    split = []
+    word = None
+    for match in _token.finditer(string):
+        kind = match.lastgroup
+        if kind == 'blank':
+            if word is not None:
+                split.append(''.join(word))
+                word = None
+            continue
+
+        if kind == 'unmatched':
+            raise ValueError("unmatched quote")
+
+        if word is None:
+            word = []
 
-    # Turn escaped characters into character literals
-    escaped = []
-    while array:
-        item = array.pop(0)
-        if item == '\\' and array:
-            escaped.append(_Literal(array.pop(0)))
+        if kind == 'quoted':
+            word.append(_escape.sub(r'\1', match.group(kind)))
         else:
-            escaped.append(item)
+            word.append(match.group(kind))
 
-    # Turn quoted string into word literals.
-    quoted = []
-    while escaped:
-        item = escaped.pop(0)
-        if item == '"':
-            word = []
-            while escaped:
-                item = escaped.pop(0)
-                if item =='"':
-                    quoted.append(_Literal(word))
-                    break
-                else:
-                    word.append(item)
+    if word is not None:
+        split.append(''.join(word))
+
+    return split
+
+class Command:
+    """Metadata for a function marked with the command decorator
+
+    The signature of the function is inspected once when it is
+    decorated, after which calls only need to check the number of
+    arguments given.  The first parameter is taken to be self.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.signature = signature(func)
+
+        self.min_args = 0
+        self.max_args = 0
+        usage = []
+        for param in list(self.signature.parameters.values())[1:]:
+            if param.kind == param.VAR_POSITIONAL:
+                self.max_args = None
+                usage.append('[{}...]'.format(param.name))
+            elif param.default is param.empty:
+                self.min_args += 1
+                self.max_args += 1
+                usage.append('<{}>'.format(param.name))
             else:
-                raise ValueError("unmatched quote")
-        else:
-            quoted.append(item)
+                self.max_args += 1
+                usage.append('[{}]'.format(param.name))
 
-    # Join adjacent sequences of literals and characters not
-    # separated by blanks.
-    split = []
-    word = []
-    while quoted:
-        item = quoted.pop(0)
-        if item != " " and item != "\t":
-            word.append(item)
-        elif word:
-            split.append(_Literal(word))
-            word.clear()
-    if word:
-        split.append(_Literal(word))
-
-    # Turn the sequence of literals into a list of strings
-    return list(map(lambda l: l.characters, split))
+        self.arguments = ' '.join(usage)
+
+    def usage(self, name=None):
+        """Returns a usage line for the command"""
+        return ' '.join(filter(None, (name or self.name, self.arguments)))
+
+    def check(self, args, name=None):
+        """Raises TypeError if args are not valid for the command"""
+        if (len(args) < self.min_args
+                or self.max_args is not None and len(args) > self.max_args):
+            raise TypeError("usage: {}".format(self.usage(name)))
+
+    def __call__(self, obj, *args):
+        self.check(args)
+        return self.func(obj, *args)
 
 def command(func):
     """Decorator marking a function as command"""
     func.is_command = True
+    func.command = Command(func)
     return func
 
 def is_command(func):
     """Returns true if the function is a command"""
     return getattr(func, "is_command", False)
 
+@lru_cache(maxsize=None)
+def commands(cls, prefix=''):
+    """Returns a dict of command name to Command for a class
+
+    Only attributes starting with prefix are considered, and the prefix
+    is stripped from the command names.  The result is cached per class
+    and must not be modified.
+    """
+    registry = {}
+    for name in dir(cls):
+        if name.startswith(prefix):
+            func = getattr_static(cls, name)
+            if is_command(func):
+                registry[name[len(prefix):]] = func.command
+
+    return registry
+
+def run_command(registry, obj, words, reply):
+    """Run the command named by the first word on obj
+
+    The command is looked up in registry, as returned by commands, and
+    called with the rest of the words as arguments.  Its response, if
+    not None, is passed to reply, as is an error message when there are
+    no words, the command is unknown, the arguments do not fit it or it
+    raises an exception.
+    """
+    if not words:
+        reply("error: empty command")
+        return
+
+    handler = registry.get(words[0])
+    if handler is None:
+        reply("error: '{}' unknown command".format(words[0]))
+        return
+
+    try:
+        handler.check(words[1:], words[0])
+        response = handler.func(obj, *words[1:])
+    except Exception as e:
+        reply("error: {}".format(e))
+    else:
+        if response is not None:
+            reply(response)
+
 def get_commands(obj):
     """Returns the names of all commands in an object"""
-    return [name for name in dir(obj) if is_command(getattr_static(obj, name))]
+    cls = obj if isinstance(obj, type) else type(obj)
+    return list(commands(cls))
 
 def parameters(func):
     """Generator returing the parameters for a function"""
-    for param in signature(func).parameters.values():
+    if is_command(func):
+        params = list(func.command.signature.parameters.values())
+        if ismethod(func):
+            del params[0]
+    else:
+        params = signature(func).parameters.values()
+
+    for param in params:
         if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
             yield param
         elif param.kind == param.VAR_POSITIONAL:
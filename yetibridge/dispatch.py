@@ -0,0 +1,205 @@
+import logging
+import queue
+import threading
+from collections import deque
+
+from .event import Event, Name, Target
+
+
+def _dispatch_to(manager, bridge, event):
+    # Exceptions from a bridge dispatched off the manager's thread are
+    # handed back to the manager to be raised there.
+    try:
+        bridge._dispatch(event)
+    except Exception as e:
+        logging.exception("Error dispatching %s", event)
+        manager.events.put(Event(bridge, Target.Manager, Name.exception, e))
+
+
+class BridgeWorker:
+    """Dispatches events to a bridge from a dedicated thread
+
+    Events handed to the worker are placed in an inbox and dispatched
+    to the bridge in order by the worker's own thread, so that a bridge
+    blocking in a handler only delays its own events.  Once maxsize
+    events are waiting, messages and actions wait up to timeout for
+    room and are then dropped.  A worker that ran out of time is marked
+    stalled and drops them at once until it has room again.  Other
+    events are always queued, as bridges need them to keep track of
+    channels and users.
+    """
+
+    # Events that may be dropped for a bridge that is falling behind
+    _sheddable = frozenset((Name.message, Name.action))
+
+    def __init__(self, manager, bridge, maxsize=0, timeout=1):
+        self.manager = manager
+        self.bridge = bridge
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.stalled = False
+        self.shed = 0
+        self.inbox = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        return self.inbox.qsize()
+
+    def _dispatch(self, event):
+        if event.name in self._sheddable and not self._room():
+            self.shed += 1
+            return
+
+        self.inbox.put(event)
+
+    def _room(self):
+        if not self.maxsize:
+            return True
+
+        inbox = self.inbox
+        timeout = 0 if self.stalled else self.timeout
+        with inbox.not_full:
+            room = inbox.not_full.wait_for(
+                lambda: inbox._qsize() < self.maxsize, timeout)
+
+        if room == self.stalled:
+            self.stalled = not room
+            name = self.manager.bridges.name_of(id(self.bridge), None)
+            if self.stalled:
+                logging.warning("Inbox of %s is full, dropping messages",
+                                name)
+            else:
+                logging.warning("Inbox of %s has room again, %d messages "
+                                "dropped so far", name, self.shed)
+        return room
+
+    def stop(self):
+        """Have the worker exit once it has dispatched the queued events"""
+        self.inbox.put(None)
+
+    def join(self, timeout=None):
+        """Wait for the worker to exit, returns False if it did not"""
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def run(self):
+        while True:
+            event = self.inbox.get()
+            if event is None:
+                break
+
+            _dispatch_to(self.manager, self.bridge, event)
+
+
+class _Lane:
+    __slots__ = ('key', 'outlet', 'events', 'scheduled')
+
+    def __init__(self, key, outlet):
+        self.key = key
+        self.outlet = outlet
+        self.events = deque()
+        self.scheduled = False
+
+
+class ChannelPartitions:
+    """Pool of threads dispatching events in per-channel lanes
+
+    Events are queued in a lane per bridge and channel, and each lane is
+    dispatched in order by one thread at a time.  Threads take turns
+    between the lanes that have events, quantum events at a time, so
+    that a flood in one channel does not hold up the others.  A bridge
+    is only called from several threads at once, each for a different
+    channel, if it sets channel_safe.  Otherwise its lanes take turns.
+    """
+
+    def __init__(self, manager, size, quantum=16):
+        self.manager = manager
+        self.quantum = quantum
+        self._lanes = {}
+        self._ready = deque()
+        self._busy = set()
+        self._pending = 0
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self.threads = [threading.Thread(target=self.run, daemon=True)
+                        for i in range(size)]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def depths(self):
+        """Return a dict of lane key to the events waiting in it"""
+        with self._lock:
+            return {k: len(l.events) for k, l in self._lanes.items()}
+
+    def put(self, event, outlet, channel_id=None):
+        """Queue an event for outlet in the lane of channel_id
+
+        Events without a channel go in a lane of the outlet's own.
+        """
+        key = (id(outlet), channel_id)
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane(key, outlet)
+
+            lane.events.append(event)
+            self._pending += 1
+            if not lane.scheduled:
+                lane.scheduled = True
+                self._ready.append(lane)
+                self._work.notify()
+
+    def join(self):
+        """Wait until every event put so far has been dispatched"""
+        with self._lock:
+            self._idle.wait_for(lambda: not self._pending)
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._work.notify_all()
+
+    def _take(self):
+        # The first ready lane whose bridge may be dispatched now
+        for lane in self._ready:
+            if lane.outlet.channel_safe or lane.key[0] not in self._busy:
+                self._ready.remove(lane)
+                return lane
+
+    def run(self):
+        while True:
+            with self._lock:
+                lane = self._take()
+                while lane is None and not self._stopping:
+                    self._work.wait()
+                    lane = self._take()
+
+                if lane is None:
+                    break
+
+                if not lane.outlet.channel_safe:
+                    self._busy.add(lane.key[0])
+                count = min(self.quantum, len(lane.events))
+                batch = [lane.events.popleft() for i in range(count)]
+
+            for event in batch:
+                _dispatch_to(self.manager, lane.outlet, event)
+
+            with self._lock:
+                self._busy.discard(lane.key[0])
+                self._pending -= len(batch)
+                if lane.events:
+                    self._ready.append(lane)
+                else:
+                    lane.scheduled = False
+                    del self._lanes[lane.key]
+
+                if self._ready:
+                    self._work.notify_all()
+                if not self._pending:
+                    self._idle.notify_all()
@@ -1,3 +1,8 @@
+import queue
+from sys import intern
+from functools import lru_cache
+from types import MappingProxyType
+
 class _TargetType:
     def __eq__(self, other):
         if isinstance(other, _TargetType):
@@ -14,28 +19,82 @@ class Target:
     AllChannels = _TargetType()
     AllUsers = _TargetType()
 
+class Name:
+    # The events an Event can be created for, unknown names are refused
+    user_add = 'user_add' # A user has joined in a channel
+    user_update = 'user_update' # User details has been updated in a channel
+    user_remove = 'user_remove' # A user has left a channel
+    user_join = 'user_join' # A user is joining a channel
+    user_change = 'user_change' # A user's details are changing in a channel
+    user_leave = 'user_leave' # A user is leaving a channel
+    user_add_bulk = 'user_add_bulk' # Many users have joined in a channel
+    user_remove_bulk = 'user_remove_bulk' # Many users have left a channel
+    user_join_bulk = 'user_join_bulk' # Many users are joining a channel
+    user_leave_bulk = 'user_leave_bulk' # Many users are leaving a channel
+    channel_add = 'channel_add' # A bridge has joined a channel
+    channel_remove = 'channel_remove' # A bridge has left a channel
+    channel_join = 'channel_join' # A bridge is joining a channel
+    channel_leave = 'channel_leave' # A bridge is leaving a channel
+    message = 'message' # Message recieved from a bridged chat or a user
+    action = 'action' # Action recieved from a bridged chat or a user
+    command = 'command' # Command recieved from a bridged chat or a user
+    exception = 'exception' # Propogate an exception
+    shutdown = 'shutdown' # Global shutdown event, all brides should detach
+    broadcast = 'broadcast' # Broadcast across the bridge
+    detach = 'detach' # Signals a bridge is detaching from the bridge manager
+
+_names = {n: intern(n) for n in vars(Name) if not n.startswith('_')}
+_no_kwargs = MappingProxyType({})
+
 class Event:
+    __slots__ = ('target_id', 'source_id', 'name', 'args', 'kwargs')
+
     def __init__(self, source, target, name, *args, **kwargs):
         self.target_id = target if type(target) is int else id(target)
         self.source_id = source if type(source) is int else id(source)
-        self.name = name
+        try:
+            self.name = _names[name]
+        except KeyError:
+            raise ValueError("unknown event name '{}'".format(name)) from None
         self.args = args
-        self.kwargs = kwargs
+        self.kwargs = kwargs or _no_kwargs
 
     def __str__(self):
         return ('Event({}, {}, {}, *{}, **{})'
                 ''.format(self.source_id, self.target_id,
-                          self.name, self.args, self.kwargs))
-
-# Some events
-'user_add' # A user has joined in a channel
-'user_update' # User details has been updated in a channel
-'user_remove' # A user has left a channel
-'user_join' # A user is joining a channel
-'user_leave' # A user is leaving a channel
-'message' # Message recieved from a bridged chat or a user
-'command' # Command recieved from a bridged chat or a user
-'exception' # Propogate an exception
-'shutdown' # Global shutdown event, all brides are expected to detach
-'broadcast' # Broadcast across the bridge
-'detach' # Signals a bridge is detaching from the bridge manager
+                          self.name, self.args, dict(self.kwargs)))
+
+class EventQueue(queue.Queue):
+    def get_batch(self, limit=None):
+        """Remove and return a list of up to limit queued events
+
+        Blocks until at least one event is available, then takes every
+        event that is ready, or limit of them if given, while holding
+        the queue lock only once.
+        """
+        with self.not_empty:
+            while not self._qsize():
+                self.not_empty.wait()
+
+            count = self._qsize()
+            if limit is not None:
+                count = min(count, limit)
+
+            batch = [self._get() for i in range(count)]
+            self.not_full.notify(count)
+            return batch
+
+@lru_cache(maxsize=None)
+def _handler_names(cls, prefix):
+    return tuple(n for n in dir(cls) if n.startswith(prefix)
+                     and callable(getattr(cls, n)))
+
+def handler_table(obj, prefix):
+    """Return a read-only mapping of event name to bound handler
+
+    Collects the methods of obj named prefix followed by an event name.
+    The method names are looked up once per class, and the returned
+    table is meant to be kept for the lifetime of obj.
+    """
+    return MappingProxyType({n[len(prefix):]: getattr(obj, n)
+                                 for n in _handler_names(type(obj), prefix)})
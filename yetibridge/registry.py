@@ -0,0 +1,61 @@
+from collections.abc import MutableMapping
+
+
+_missing = object()
+
+class Registry(MutableMapping):
+    """Mapping of names to objects with reverse lookup by object id
+
+    Behaves like a dict of name to object, but also keeps an index of
+    id(object) to name so that both directions are constant time.
+    Each object may only be registered under one name at a time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._objects = {}
+        self._names = {}
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, name):
+        return self._objects[name]
+
+    def __setitem__(self, name, obj):
+        if name in self._objects:
+            del self._names[id(self._objects[name])]
+
+        if id(obj) in self._names:
+            raise ValueError("object is already registered as '{}'"
+                             "".format(self._names[id(obj)]))
+
+        self._objects[name] = obj
+        self._names[id(obj)] = name
+
+    def __delitem__(self, name):
+        obj = self._objects.pop(name)
+        del self._names[id(obj)]
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def popitem(self):
+        """Remove and return the most recently registered item"""
+        name, obj = self._objects.popitem()
+        del self._names[id(obj)]
+        return name, obj
+
+    def name_of(self, obj_id, default=_missing):
+        """Return the name registered for the object with the given id"""
+        try:
+            return self._names[obj_id]
+        except KeyError:
+            if default is not _missing:
+                return default
+            raise KeyError("no object with id {} is registered"
+                           "".format(obj_id)) from None
+
+    def by_id(self, obj_id):
+        """Return the registered object with the given id"""
+        return self._objects[self.name_of(obj_id)]
@@ -0,0 +1,82 @@
+"""Structured message content
+
+Messages travel between bridges with mentions encoded as <[@id]>
+markers in the content string.  This module splits such content into a
+tuple of (kind, value) segments so that it only needs to be scanned
+once, however many bridges end up rendering it.  Segments are plain
+tuples of strings and ints so they can be sent to remote bridges as is.
+"""
+
+import re
+
+__all__ = ['TEXT', 'MENTION', 'URL', 'from_text', 'parse', 'join', 'render']
+
+
+TEXT = 'text' # Literal text, value is the string
+MENTION = 'mention' # Mention of a user, value is the user id
+URL = 'url' # A link, value is the URL
+
+_marker = re.compile(r'<\[@([0-9]+)\]>')
+_url = re.compile(r'https?://[^\s<>]+')
+
+
+def from_text(text):
+    """Split plain text into text and URL segments
+
+    Parameters
+    ----------
+    text : str
+        Text with no mention markers in it.
+
+    Returns a list of segments, empty if text is empty.
+    """
+    segments = []
+    pos = 0
+    for match in _url.finditer(text):
+        if match.start() > pos:
+            segments.append((TEXT, text[pos:match.start()]))
+        segments.append((URL, match.group()))
+        pos = match.end()
+
+    if pos < len(text):
+        segments.append((TEXT, text[pos:]))
+
+    return segments
+
+def parse(content):
+    """Split content in the marker form into a tuple of segments"""
+    segments = []
+    pos = 0
+    for match in _marker.finditer(content):
+        segments.extend(from_text(content[pos:match.start()]))
+        segments.append((MENTION, int(match.group(1))))
+        pos = match.end()
+
+    segments.extend(from_text(content[pos:]))
+    return tuple(segments)
+
+def join(segments):
+    """Return the content string in the marker form for segments"""
+    return ''.join('<[@{}]>'.format(v) if k == MENTION else v
+                       for k, v in segments)
+
+def render(segments, mention):
+    """Render segments into a string
+
+    Parameters
+    ----------
+    segments
+        Sequence of segments as returned by parse.
+    mention
+        Called with the user id of each mention, returns the text to
+        show for it or None to leave the marker in place.
+    """
+    parts = []
+    for kind, value in segments:
+        if kind == MENTION:
+            text = mention(value)
+            parts.append('<[@{}]>'.format(value) if text is None else text)
+        else:
+            parts.append(value)
+
+    return ''.join(parts)
@@ -3,77 +3,75 @@
 Convenient utility for text wrapping on byte boundnaries.
 """
 
+import re
+
 __all__ = ['Utf8Wrapper']
 
 
+# A word is a run of non-space bytes along with the spaces preceding it
+_word = re.compile(rb' *[^ ]+')
+
+
+def _is_continuation(byte):
+    return 0x80 <= byte < 0xC0
+
+
 class Utf8Wrapper:
     def __init__(self, **kwargs):
         self.width = kwargs.get('width', 100)
 
-    def _split_words(self, text):
-        while text:
-            word = []
-            seen_non_space = False
-            for byte in text:
-                if byte != 0x20:
-                    seen_non_space = True
-                elif seen_non_space and byte == 0x20:
-                    break
-
-                word.append(byte)
-
-            if seen_non_space:
-                yield word
-            text[:len(word)] = []
-
-    def _split_chars(self, word):
-        while word:
-            chars = [word.pop(0)]
-            for char in word:
-                if 0x80 <= char < 0xC0:
-                    chars.append(char)
+    def _char_end(self, text, pos, end):
+        pos += 1
+        while pos < end and _is_continuation(text[pos]):
+            pos += 1
+
+        return pos
+
+    def _lay_long_word(self, text, start, end):
+        # Lines hold at most width - 1 bytes, a character that does not
+        # fit starts a new line even if it is longer than that.
+        line_start = pos = start
+        while pos < end:
+            limit = line_start + self.width - 1
+            if limit >= end:
+                break
+
+            cut = limit
+            if cut <= pos:
+                cut = pos
+            else:
+                while cut > pos and _is_continuation(text[cut]):
+                    cut -= 1
+
+            yield line_start, cut
+            line_start = cut
+            pos = self._char_end(text, cut, end)
+
+        yield line_start, end
+
+    def _lay_lines(self, text):
+        line_start = line_end = None
+        for match in _word.finditer(text):
+            start, end = match.span()
+            if line_start is None:
+                if end - start < self.width:
+                    line_start, line_end = start, end
                 else:
-                    break
-
-            yield(chars)
-            word[:len(chars)-1] = []
+                    yield from self._lay_long_word(text, start, end)
 
+            elif end - start < self.width - (line_end - line_start):
+                line_end = end
 
-    def _lay_long_word(self, word):
-        chars = list(self._split_chars(word))
-        line = []
-        while chars:
-            char = chars.pop(0)
-            if len(char) < self.width - len(line):
-                line.extend(char)
             else:
-                yield line
-                line = char
-
-        if line:
-            yield line
-
-    def _lay_lines(self, words):
-        line = []
-        while words:
-            word = words.pop(0)
-            if len(word) < self.width - len(line):
-                line.extend(word)
-            elif not line:
-                for line in self._lay_long_word(word):
-                    yield bytes(line).decode('UTF-8')
-                line = []
-            else:
-                yield bytes(line).decode('UTF-8')
-                line = word
+                yield line_start, line_end
+                line_start, line_end = start, end
 
-        if line:
-            yield bytes(line).decode('UTF-8')
+        if line_start is not None:
+            yield line_start, line_end
 
     def wrap(self, text):
         text = text.encode('UTF-8')
+        view = memoryview(text)
 
-        text = list(text)
-        words = list(self._split_words(text))
-
-        return list(self._lay_lines(words))
+        return [str(view[start:end], 'UTF-8')
+                    for start, end in self._lay_lines(text)]